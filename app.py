@@ -1,5 +1,6 @@
 import os
-from flask import Flask, request, jsonify
+from datetime import datetime
+from flask import Flask, request, jsonify, Response, stream_with_context, g, send_from_directory
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt_identity
 from dotenv import load_dotenv
@@ -8,7 +9,12 @@ from dotenv import load_dotenv
 from services.auth_service import AuthService
 from services.analysis_service import AnalysisService
 from services.storage_service import StorageService
-from services.notification_service import NotificationService
+from services.notification_service import NotificationService, encode_cursor
+from services.feature_service import FeatureService
+from services.export_service import ExportService
+from services.proxy_service import ProxyService
+from services.document_loader import LoaderMetrics, begin_request, end_request
+from services.persistence import is_local, local_bucket
 
 # Load environment variables
 load_dotenv()
@@ -27,6 +33,45 @@ auth_service = AuthService()
 analysis_service = AnalysisService()
 storage_service = StorageService()
 notification_service = NotificationService()
+feature_service = FeatureService()
+export_service = ExportService()
+proxy_service = ProxyService()
+
+# Per-request document loader shared by all services
+loader_metrics = LoaderMetrics()
+
+@app.before_request
+def start_document_loader():
+    g.document_loader, g.document_loader_token = begin_request(auth_service.db)
+
+@app.after_request
+def record_document_loader(response):
+    loader = g.get('document_loader')
+    if loader is not None:
+        response.headers['X-Firestore-Round-Trips'] = str(loader.round_trips)
+    return response
+
+@app.teardown_request
+def stop_document_loader(exception=None):
+    # Runs after a streamed body is sent, so the metrics include its reads
+    loader = g.get('document_loader')
+    if loader is not None:
+        route = f"{request.method} {request.url_rule.rule}" if request.url_rule else "unmatched"
+        loader_metrics.record(route, loader)
+    token = g.pop('document_loader_token', None)
+    if token is not None:
+        end_request(token)
+
+# Media files of the local backend; Cloud Storage serves them otherwise
+if is_local():
+    @app.route('/media/<path:storage_path>', methods=['GET'])
+    def local_media(storage_path):
+        return send_from_directory(local_bucket().root, storage_path, conditional=True)
+
+@app.route('/api/metrics/firestore', methods=['GET'])
+@jwt_required()
+def get_firestore_metrics():
+    return jsonify({'routes': loader_metrics.snapshot()}), 200
 
 # Authentication routes
 @app.route('/api/auth/login', methods=['POST'])
@@ -96,6 +141,11 @@ def upload_asset(project_id):
         
     metadata = request.form.get('metadata', '{}')
     asset = storage_service.upload_asset(project_id, file, metadata)
+    
+    # Index features off the request path so analysis only compares them.
+    # Videos are indexed once their proxy exists, so frames decode from it.
+    if not proxy_service.enqueue_asset(asset, callback=feature_service.enqueue_asset):
+        feature_service.enqueue_asset(asset)
     return jsonify({'asset': asset}), 201
 
 @app.route('/api/projects/<project_id>/assets', methods=['GET'])
@@ -108,9 +158,118 @@ def get_assets(project_id):
     if not project:
         return jsonify({'error': 'Project not found'}), 404
         
-    assets = storage_service.get_project_assets(project_id)
+    # Filters are answered from the search index instead of a collection scan
+    if any(key in request.args for key in ['scene', 'type', 'tags']):
+        assets = storage_service.search_assets(
+            project_id,
+            tags=[tag for tag in request.args.get('tags', '').split(',') if tag],
+            scene=request.args.get('scene'),
+            asset_type=request.args.get('type')
+        )
+    else:
+        assets = storage_service.get_project_assets(project_id)
+    return jsonify({'assets': assets}), 200
+
+@app.route('/api/projects/<project_id>/assets/search', methods=['GET'])
+@jwt_required()
+def search_assets(project_id):
+    user_id = get_jwt_identity()
+    
+    # Check if project exists and user has access
+    project = storage_service.get_project(project_id, user_id)
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+        
+    try:
+        uploaded_after = request.args.get('uploaded_after')
+        uploaded_before = request.args.get('uploaded_before')
+        uploaded_after = datetime.fromisoformat(uploaded_after.replace('Z', '+00:00')) if uploaded_after else None
+        uploaded_before = datetime.fromisoformat(uploaded_before.replace('Z', '+00:00')) if uploaded_before else None
+    except ValueError:
+        return jsonify({'error': 'Invalid upload time range'}), 400
+        
+    assets = storage_service.search_assets(
+        project_id,
+        tags=[tag for tag in request.args.get('tags', '').split(',') if tag],
+        scene=request.args.get('scene'),
+        shot=request.args.get('shot'),
+        content_type=request.args.get('content_type'),
+        asset_type=request.args.get('type'),
+        uploaded_after=uploaded_after,
+        uploaded_before=uploaded_before
+    )
     return jsonify({'assets': assets}), 200
 
+@app.route('/api/projects/<project_id>/assets/<asset_id>', methods=['DELETE'])
+@jwt_required()
+def delete_asset(project_id, asset_id):
+    user_id = get_jwt_identity()
+    
+    # Check if project exists and user has access
+    project = storage_service.get_project(project_id, user_id)
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+        
+    if not storage_service.delete_asset(project_id, asset_id):
+        return jsonify({'error': 'Asset not found'}), 404
+        
+    return jsonify({'message': 'Asset deleted successfully'}), 200
+
+@app.route('/api/projects/<project_id>/assets/<asset_id>/proxy', methods=['GET'])
+@jwt_required()
+def get_asset_proxy(project_id, asset_id):
+    user_id = get_jwt_identity()
+    
+    # Check if project exists and user has access
+    project = storage_service.get_project(project_id, user_id)
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+        
+    asset = storage_service.get_asset(project_id, asset_id)
+    proxy = (asset or {}).get('proxy')
+    if not proxy:
+        return jsonify({'error': 'Proxy not found'}), 404
+        
+    size = storage_service.get_blob_size(proxy['storage_path'])
+    if size is None:
+        return jsonify({'error': 'Proxy not found'}), 404
+        
+    # Serve only the requested byte range so players can seek without
+    # downloading the whole file
+    headers = {'Accept-Ranges': 'bytes'}
+    byte_range = request.range
+    if byte_range and byte_range.units == 'bytes' and len(byte_range.ranges) == 1:
+        content_range = byte_range.range_for_length(size)
+        if content_range is None:
+            return Response(status=416, headers=dict(headers, **{'Content-Range': f"bytes */{size}"}))
+        start, stop = content_range
+        headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+        status = 206
+    else:
+        start, stop = 0, size
+        status = 200
+    headers['Content-Length'] = str(stop - start)
+        
+    return Response(
+        stream_with_context(storage_service.stream_blob(proxy['storage_path'], start, stop - 1)),
+        status=status,
+        mimetype='video/mp4',
+        headers=headers
+    )
+
+@app.route('/api/projects/<project_id>/features/reindex', methods=['POST'])
+@jwt_required()
+def reindex_features(project_id):
+    user_id = get_jwt_identity()
+    
+    # Check if project exists and user has access
+    project = storage_service.get_project(project_id, user_id)
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+        
+    queued = feature_service.reindex_project(project_id)
+    return jsonify({'queued': len(queued)}), 202
+
 # Analysis routes
 @app.route('/api/projects/<project_id>/analyze', methods=['POST'])
 @jwt_required()
@@ -130,7 +289,8 @@ def analyze_project(project_id):
     result = analysis_service.run_analysis(analysis_id)
     
     # Send notification
-    notification_service.send_analysis_complete(user_id, project_id, analysis_id)
+    if result.get('status') in ('completed', 'partial'):
+        notification_service.send_analysis_complete(user_id, project_id, analysis_id)
     
     return jsonify({'analysis_id': analysis_id, 'result': result}), 200
 
@@ -163,6 +323,93 @@ def get_analysis(project_id, analysis_id):
         
     return jsonify({'analysis': analysis}), 200
 
+@app.route('/api/projects/<project_id>/analysis/<analysis_id>/cancel', methods=['POST'])
+@jwt_required()
+def cancel_analysis(project_id, analysis_id):
+    user_id = get_jwt_identity()
+    
+    # Check if project exists and user has access
+    project = storage_service.get_project(project_id, user_id)
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+        
+    analysis = analysis_service.get_analysis(analysis_id)
+    if not analysis or analysis['project_id'] != project_id:
+        return jsonify({'error': 'Analysis not found'}), 404
+        
+    status, requested = analysis_service.cancel_analysis(analysis_id)
+    if not requested:
+        # completed, partial, cancelled or failed: nothing left to cancel
+        return jsonify({'error': f"Analysis is already {status}"}), 409
+        
+    return jsonify({'analysis_id': analysis_id, 'status': status}), 202
+
+@app.route('/api/projects/<project_id>/analysis/<analysis_id>/resume', methods=['POST'])
+@jwt_required()
+def resume_analysis(project_id, analysis_id):
+    user_id = get_jwt_identity()
+    
+    # Check if project exists and user has access
+    project = storage_service.get_project(project_id, user_id)
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+        
+    analysis = analysis_service.get_analysis(analysis_id)
+    if not analysis or analysis['project_id'] != project_id:
+        return jsonify({'error': 'Analysis not found'}), 404
+        
+    # Picks up from the last checkpoint unless a live worker holds the lease
+    # or the analysis is already final, which is reported as an error
+    result = analysis_service.run_analysis(analysis_id)
+    if 'error' in result:
+        return jsonify(result), 409
+        
+    # Only a run that finished here notifies
+    if result.get('status') in ('completed', 'partial'):
+        notification_service.send_analysis_complete(user_id, project_id, analysis_id)
+    
+    return jsonify({'analysis_id': analysis_id, 'result': result}), 200
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'jsonl': ('application/x-ndjson', 'jsonl'),
+    'html': ('text/html', 'html')
+}
+
+@app.route('/api/projects/<project_id>/analysis/<analysis_id>/export', methods=['GET'])
+@jwt_required()
+def export_analysis(project_id, analysis_id):
+    user_id = get_jwt_identity()
+    
+    # Check if project exists and user has access
+    project = storage_service.get_project(project_id, user_id)
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+        
+    analysis = analysis_service.get_analysis(analysis_id)
+    if not analysis or analysis['project_id'] != project_id:
+        return jsonify({'error': 'Analysis not found'}), 404
+        
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unsupported export format: {export_format}"}), 400
+        
+    # Stream the export so memory stays flat regardless of issue count
+    if export_format == 'csv':
+        chunks = export_service.stream_csv(analysis)
+    elif export_format == 'jsonl':
+        chunks = export_service.stream_jsonl(analysis)
+    else:
+        chunks = export_service.stream_html_report(analysis, project)
+        
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    disposition = 'inline' if export_format == 'html' else 'attachment'
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'{disposition}; filename="analysis-{analysis_id}.{extension}"'}
+    )
+
 # Continuity rule routes
 @app.route('/api/rules', methods=['GET'])
 @jwt_required()
@@ -179,6 +426,43 @@ def create_rule():
     rule = storage_service.create_rule(user_id, data)
     return jsonify({'rule': rule}), 201
 
+# Notification routes
+@app.route('/api/notifications', methods=['GET'])
+@jwt_required()
+def get_notifications():
+    user_id = get_jwt_identity()
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    cursor = request.args.get('cursor')
+    
+    notifications = notification_service.get_user_notifications(user_id, limit=limit, cursor=cursor)
+    
+    # A full page means there may be more after the last notification
+    next_cursor = encode_cursor(notifications[-1]) if notifications and len(notifications) == limit else None
+    return jsonify({'notifications': notifications, 'next_cursor': next_cursor}), 200
+
+@app.route('/api/notifications/unread_count', methods=['GET'])
+@jwt_required()
+def get_unread_notification_count():
+    user_id = get_jwt_identity()
+    unread_count = notification_service.get_unread_count(user_id)
+    return jsonify({'unread_count': unread_count}), 200
+
+@app.route('/api/notifications/read', methods=['POST'])
+@jwt_required()
+def mark_notifications_read():
+    user_id = get_jwt_identity()
+    data = request.get_json() or {}
+    
+    if data.get('all'):
+        updated = notification_service.mark_all_notifications_read(user_id)
+    else:
+        notification_ids = data.get('notification_ids', [])
+        if not notification_ids:
+            return jsonify({'error': 'No notifications specified'}), 400
+        updated = notification_service.mark_notifications_read(user_id, notification_ids)
+    
+    return jsonify({'updated': updated}), 200
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
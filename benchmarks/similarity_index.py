@@ -0,0 +1,68 @@
+"""Benchmark the similarity index on synthetic shot features
+
+Shots are drawn around a number of "setups" (same set, character, angle)
+that recur across scenes. Reports index build time, recall of the LSH top-k
+against exact brute-force top-k, and the reduction in compared pairs.
+
+Usage: python -m benchmarks.similarity_index [num_assets] [top_k]
+"""
+import sys
+import time
+import numpy as np
+
+from services.similarity_index import SimilarityIndex
+
+
+def synthetic_dataset(num_assets, num_setups=200, num_scenes=60, dimensions=198, noise=0.6, seed=7):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_setups, dimensions))
+    setups = rng.integers(0, num_setups, num_assets)
+    vectors = centers[setups] + noise * rng.standard_normal((num_assets, dimensions))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    scenes = rng.integers(0, num_scenes, num_assets)
+    return vectors, scenes
+
+
+def exact_top_k(vectors, scenes, index, k):
+    similarities = vectors @ vectors[index]
+    similarities[scenes == scenes[index]] = -np.inf
+    top = np.argpartition(-similarities, k - 1)[:k]
+    return set(top.tolist())
+
+
+def main(num_assets=20000, top_k=10, sample=500):
+    vectors, scenes = synthetic_dataset(num_assets)
+
+    start = time.perf_counter()
+    index = SimilarityIndex().build(vectors)
+    build_seconds = time.perf_counter() - start
+
+    rng = np.random.default_rng(0)
+    sample_rows = rng.choice(num_assets, size=min(sample, num_assets), replace=False)
+
+    hits = 0
+    query_seconds = 0.0
+    for row in sample_rows:
+        scene = scenes[row]
+        start = time.perf_counter()
+        found = index.query(row, top_k, allowed=lambda other: scenes[other] != scene)
+        query_seconds += time.perf_counter() - start
+        hits += len({neighbour for neighbour, _ in found} & exact_top_k(vectors, scenes, row, top_k))
+    query_seconds /= len(sample_rows)
+
+    _, scene_counts = np.unique(scenes, return_counts=True)
+    all_pairs = (num_assets * num_assets - int((scene_counts ** 2).sum())) // 2
+    # Upper bound: each asset contributes at most top_k pairs
+    candidate_pairs = num_assets * top_k
+
+    print(f"assets:            {num_assets}")
+    print(f"build time:        {build_seconds:.3f}s")
+    print(f"query time:        {query_seconds * 1000:.2f}ms")
+    print(f"recall@{top_k}:         {hits / (len(sample_rows) * top_k):.3f}")
+    print(f"cross-scene pairs: {all_pairs}")
+    print(f"indexed pairs:     <= {candidate_pairs} ({all_pairs / candidate_pairs:.0f}x fewer)")
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:3]]
+    main(*args)
@@ -2,17 +2,269 @@ import os
 import uuid
 import json
 import time
-from datetime import datetime
+import socket
+import threading
+from datetime import datetime, timedelta, timezone
+from itertools import islice
 from firebase_admin import firestore
 import requests
 
 # Placeholder for Gemini API integration
 from services.gemini_service import GeminiService
+from services.feature_service import FeatureService
+from services.continuity_checks import AssetRecord, SummaryBuilder, iter_cross_scene_pairs, build_summary
+from services.rule_engine import RuleEngine
+from services.similarity_index import similar_pairs, SIMILARITY_FEATURES
+from services.shard_executor import ShardedAnalysisExecutor, DEFAULT_MAX_PAIRS_PER_SHARD, plan_shards, merge_shard_results
+from services.pair_scheduler import AnalysisBudget, BudgetExhausted, MeteredGeminiService, rule_passes, iter_scheduled_pairs, count_pairs
+from services.document_loader import loader_for
+from services.persistence import get_database, transactional
+
+# A worker that stops renewing its lease for this long is considered dead
+LEASE_SECONDS = 120
+# Leases are renewed this often while a run is in progress, however long
+# a single pair or shard takes
+HEARTBEAT_SECONDS = 30
+CHECKPOINT_EVERY_PAIRS = 500
+CHECKPOINT_EVERY_SECONDS = 30
+FINAL_STATUSES = ['completed', 'partial', 'cancelled', 'failed']
+# Firestore allows at most 500 writes per batch
+WRITE_BATCH_SIZE = 500
+ASSET_PAGE_SIZE = 1000
+
+
+def lease_for(worker_id):
+    """Build a lease record held by worker_id for LEASE_SECONDS from now"""
+    return {
+        'worker_id': worker_id,
+        'expires_at': datetime.now(timezone.utc) + timedelta(seconds=LEASE_SECONDS)
+    }
+
+
+@transactional
+def _claim_analysis(transaction, analysis_ref, worker_id):
+    """Take the lease on an analysis unless a live worker holds it
+
+    Returns (analysis, reason); reason is None when the lease was granted.
+    """
+    snapshot = analysis_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None, 'not_found'
+
+    analysis = snapshot.to_dict()
+    if analysis.get('status') in FINAL_STATUSES:
+        return analysis, analysis['status']
+
+    lease = analysis.get('lease') or {}
+    if lease.get('worker_id') not in (None, worker_id) and lease.get('expires_at') \
+            and lease['expires_at'] > datetime.now(timezone.utc):
+        return analysis, 'leased'
+
+    transaction.update(analysis_ref, {
+        'status': 'processing',
+        'lease': lease_for(worker_id),
+        'heartbeat_at': firestore.SERVER_TIMESTAMP
+    })
+    return analysis, None
+
+
+@transactional
+def _renew_lease(transaction, analysis_ref, worker_id, checkpoint):
+    """Save a checkpoint and extend the lease if this worker still holds it
+
+    Returns why the run should stop ('cancelled' or 'lease_lost'), or None.
+    """
+    snapshot = analysis_ref.get(transaction=transaction)
+    current = snapshot.to_dict() or {}
+    if (current.get('lease') or {}).get('worker_id') != worker_id:
+        return 'lease_lost'
+
+    transaction.update(analysis_ref, {
+        'checkpoint': checkpoint,
+        'lease': lease_for(worker_id),
+        'heartbeat_at': firestore.SERVER_TIMESTAMP
+    })
+    return 'cancelled' if current.get('cancel_requested') else None
+
+
+@transactional
+def _extend_lease(transaction, analysis_ref, worker_id):
+    """Extend the lease if this worker still holds it, without a checkpoint
+
+    Returns why the run should stop ('cancelled' or 'lease_lost'), or None.
+    """
+    snapshot = analysis_ref.get(transaction=transaction)
+    current = snapshot.to_dict() or {}
+    if (current.get('lease') or {}).get('worker_id') != worker_id:
+        return 'lease_lost'
+
+    transaction.update(analysis_ref, {
+        'lease': lease_for(worker_id),
+        'heartbeat_at': firestore.SERVER_TIMESTAMP
+    })
+    return 'cancelled' if current.get('cancel_requested') else None
+
+
+@transactional
+def _fail_analysis(transaction, analysis_ref, worker_id, error):
+    """Mark an analysis failed if this worker still holds its lease"""
+    snapshot = analysis_ref.get(transaction=transaction)
+    current = snapshot.to_dict() or {}
+    if (current.get('lease') or {}).get('worker_id') != worker_id:
+        return False
+
+    transaction.update(analysis_ref, {
+        'status': 'failed',
+        'error': error,
+        'completed_at': firestore.SERVER_TIMESTAMP,
+        'lease': firestore.DELETE_FIELD,
+        'checkpoint': firestore.DELETE_FIELD
+    })
+    return True
+
+
+@transactional
+def _request_cancel(transaction, analysis_ref):
+    """Flag an analysis for cancellation
+
+    Returns (status, requested): the status after the request, or None if
+    the analysis is missing, and whether a cancel was recorded.
+    """
+    snapshot = analysis_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None, False
+
+    status = snapshot.to_dict().get('status')
+    if status == 'pending':
+        # Nothing has run yet, so there are no partial results to keep
+        transaction.update(analysis_ref, {
+            'status': 'cancelled',
+            'cancel_requested': True,
+            'completed_at': firestore.SERVER_TIMESTAMP
+        })
+        return 'cancelled', True
+    if status == 'processing':
+        transaction.update(analysis_ref, {'cancel_requested': True})
+        return status, True
+    return status, False
+
+
+class AnalysisCheckpoint:
+    """Tracks progress of a running analysis and persists it periodically
+
+    state holds the asset order the pair plan was built from, a cursor into
+    that plan and the issues found so far. Saving also renews the worker's
+    lease and picks up cancel requests made through the API. Between saves,
+    a heartbeat thread keeps the lease alive while the run is working.
+    """
+
+    def __init__(self, db, analysis_ref, worker_id, state, cancel_requests,
+                 every_pairs=CHECKPOINT_EVERY_PAIRS, every_seconds=CHECKPOINT_EVERY_SECONDS):
+        self.db = db
+        self.analysis_ref = analysis_ref
+        self.worker_id = worker_id
+        self.state = state
+        self.cancel_requests = cancel_requests
+        self.every_pairs = every_pairs
+        self.every_seconds = every_seconds
+        self.pairs_since_save = 0
+        self.last_saved = time.monotonic()
+        self.stop_reason = None
+        # Called before each save, e.g. to store issues the checkpoint counts
+        self.before_save = None
+        self._heartbeat = None
+        self._heartbeat_stopped = threading.Event()
+
+    def advance(self, pairs=1):
+        """Record progress; returns True when the run should stop"""
+        self.pairs_since_save += pairs
+        if self.analysis_ref.id in self.cancel_requests:
+            self.stop_reason = 'cancelled'
+        elif self.pairs_since_save >= self.every_pairs or time.monotonic() - self.last_saved >= self.every_seconds:
+            self.save()
+        return self.stop_reason is not None
+
+    def save(self):
+        """Persist the checkpoint and renew the lease"""
+        if self.before_save:
+            self.before_save()
+        self.stop_reason = _renew_lease(self.db.transaction(), self.analysis_ref, self.worker_id, self.state) \
+            or self.stop_reason
+        self.pairs_since_save = 0
+        self.last_saved = time.monotonic()
+
+    def start_heartbeat(self, interval=HEARTBEAT_SECONDS):
+        """Renew the lease every interval seconds until stop_heartbeat()"""
+        self._heartbeat = threading.Thread(
+            target=self._beat, args=(interval,), daemon=True, name=f"lease-{self.analysis_ref.id}"
+        )
+        self._heartbeat.start()
+
+    def stop_heartbeat(self):
+        if self._heartbeat is not None:
+            self._heartbeat_stopped.set()
+            self._heartbeat.join()
+            self._heartbeat = None
+
+    def _beat(self, interval):
+        while not self._heartbeat_stopped.wait(interval):
+            try:
+                reason = _extend_lease(self.db.transaction(), self.analysis_ref, self.worker_id)
+            except Exception as e:
+                # The lease has LEASE_SECONDS to spare; try again next beat
+                print(f"Error renewing lease for {self.analysis_ref.id}: {str(e)}")
+                continue
+            if reason:
+                # Seen by the run at its next pair or shard
+                self.stop_reason = self.stop_reason or reason
+            if reason == 'lease_lost':
+                return
+
+
+class IssueStream:
+    """Stores issues in an analysis' issues subcollection as they are found
+
+    Only the running count and summary are kept, in the checkpoint state, so
+    memory does not grow with the number of issues. Documents are keyed by
+    sequence number: issues found again after resuming from a checkpoint
+    overwrite the copies written before the interruption.
+    """
+
+    def __init__(self, db, analysis_ref, state, batch_size=WRITE_BATCH_SIZE):
+        self.db = db
+        self.issues_ref = analysis_ref.collection('issues')
+        self.state = state
+        self.summary = SummaryBuilder(state['summary'])
+        self.batch_size = batch_size
+        self.batch = db.batch()
+        self.pending = 0
+
+    def extend(self, issues):
+        for issue in issues:
+            seq = self.state['issue_count']
+            self.batch.set(self.issues_ref.document(f"{seq:010d}"), dict(issue, seq=seq))
+            self.summary.add(issue)
+            self.state['issue_count'] += 1
+            self.pending += 1
+            if self.pending == self.batch_size:
+                self.flush()
+
+    def flush(self):
+        """Commit the writes not yet stored"""
+        if not self.pending:
+            return
+        self.batch.commit()
+        self.batch = self.db.batch()
+        self.pending = 0
+
 
 class AnalysisService:
     def __init__(self):
-        self.db = firestore.client()
+        self.db = get_database()
         self.gemini_service = GeminiService()
+        self.feature_service = FeatureService()
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._cancel_requests = set()
     
     def create_analysis_job(self, project_id, data):
         """Create a new analysis job"""
@@ -26,116 +278,379 @@ class AnalysisService:
             'created_at': firestore.SERVER_TIMESTAMP,
             'continuity_rules': data.get('continuity_rules', []),
             'media_assets': data.get('media_assets', []),
-            'parameters': data.get('parameters', {})
+            'parameters': data.get('parameters', {}),
+            'notification_settings': data.get('notification_settings', {})
         }
         
         # Store in Firestore
-        self.db.collection('analyses').document(analysis_id).set(analysis_data)
+        loader_for(self.db).set('analyses', analysis_id, analysis_data)
         
         return analysis_id
     
     def run_analysis(self, analysis_id):
-        """Run the analysis job"""
-        # Get analysis data
+        """Run the analysis job, resuming from its last checkpoint if it has one"""
+        # Get analysis data and take the lease
+        loader = loader_for(self.db)
         analysis_ref = self.db.collection('analyses').document(analysis_id)
-        analysis = analysis_ref.get().to_dict()
+        created = loader.peek('analyses', analysis_id) if ('analyses', analysis_id) in loader.created else None
+        if created and created.get('status') == 'pending' and not created.get('lease'):
+            # Created by this request, so its ID is not known to any other worker
+            # yet; take the lease without re-reading it in a transaction
+            loader.update('analyses', analysis_id, {
+                'status': 'processing',
+                'lease': lease_for(self.worker_id),
+                'heartbeat_at': firestore.SERVER_TIMESTAMP
+            })
+            analysis, reason = created, None
+        else:
+            analysis, reason = _claim_analysis(self.db.transaction(), analysis_ref, self.worker_id)
         
         if not analysis:
             return {'error': 'Analysis not found'}
+        if reason == 'leased':
+            return {'error': 'Analysis is running on another worker'}
+        if reason:
+            # Already final; the stored results are in the analysis record
+            return {'error': f"Analysis is already {reason}", 'status': reason}
         
-        # Update status
-        analysis_ref.update({'status': 'processing'})
-        
-        # Get assets for analysis
-        assets = analysis.get('media_assets', [])
-        if not assets:
-            # If no specific assets provided, get all project assets
-            project_assets = self.db.collection('assets').where('project_id', '==', analysis['project_id']).stream()
-            assets = [doc.to_dict() for doc in project_assets]
+        try:
+            return self._run_claimed(analysis_id, analysis_ref, analysis)
+        except Exception as e:
+            # A job that fails once would fail again, so it is not left for
+            # resume_stale_analyses to retry
+            print(f"Error running analysis {analysis_id}: {str(e)}")
+            self._cancel_requests.discard(analysis_id)
+            if _fail_analysis(self.db.transaction(), analysis_ref, self.worker_id, str(e)):
+                return {'error': f"Analysis failed: {str(e)}", 'status': 'failed'}
+            return {'error': 'Analysis was taken over by another worker'}
+    
+    def _run_claimed(self, analysis_id, analysis_ref, analysis):
+        """Run an analysis this worker holds the lease on"""
+        loader = loader_for(self.db)
         
         # Get continuity rules
         rules = analysis.get('continuity_rules', [])
+        parameters = analysis.get('parameters', {})
+        streaming = bool(parameters.get('streaming'))
+        saved = analysis.get('checkpoint') or {}
+        budget = AnalysisBudget.from_parameters(parameters, usage=saved.get('usage'))
         
-        # Process each asset pair for continuity issues
-        continuity_issues = []
-        
-        # This is a simplified example
-        # In a real implementation, you would perform much more sophisticated analysis
-        for i, asset1 in enumerate(assets):
-            for j, asset2 in enumerate(assets[i+1:], i+1):
-                # Only compare assets from different scenes
-                scene1 = asset1.get('scene_info', {}).get('scene_number')
-                scene2 = asset2.get('scene_info', {}).get('scene_number')
-                
-                if scene1 and scene2 and scene1 != scene2:
-                    # For each rule, check continuity
-                    for rule in rules:
-                        # Here we would use Gemini API to analyze visual elements
-                        # This is a placeholder for demonstration purposes
-                        if rule.get('rule_type') == 'object_tracking':
-                            # Use Gemini API to identify objects in both scenes
-                            objects1 = self.gemini_service.identify_objects(asset1.get('url'))
-                            objects2 = self.gemini_service.identify_objects(asset2.get('url'))
-                            
-                            # Compare objects for inconsistencies
-                            # For demo, we'll just create a simulated issue
-                            issue = {
-                                'issue_id': str(uuid.uuid4()),
-                                'type': 'object_mismatch',
-                                'severity': 'warning',
-                                'description': f"Possible object inconsistency between scene {scene1} and {scene2}",
-                                'affected_assets': [asset1.get('asset_id'), asset2.get('asset_id')],
-                                'affected_scenes': [scene1, scene2],
-                                'frames': [100, 200],  # Placeholder frame numbers
-                                'confidence_score': 0.85,
-                                'suggested_resolution': "Verify that the prop appears consistently"
-                            }
-                            continuity_issues.append(issue)
-        
-        # Create summary
-        summary = {
-            'total_issues': len(continuity_issues),
-            'by_severity': {
-                'error': sum(1 for issue in continuity_issues if issue['severity'] == 'error'),
-                'warning': sum(1 for issue in continuity_issues if issue['severity'] == 'warning'),
-                'info': sum(1 for issue in continuity_issues if issue['severity'] == 'info')
-            },
-            'by_type': {}
-        }
+        if streaming:
+            # Compact records with only the features the run reads, loaded page by page
+            feature_names = set(RuleEngine(rules).required_features()) | {'objects'}
+            if parameters.get('top_k') or budget:
+                feature_names.update(SIMILARITY_FEATURES)
+            assets = self._load_asset_records(analysis, saved.get('last_asset_id'), feature_names)
+        else:
+            # Get assets for analysis, in the order of the previous run if resuming
+            assets = self._load_assets(analysis, saved.get('asset_ids'))
+            # Use features precomputed at upload time instead of extracting per pair
+            self.feature_service.attach_features(assets)
         
-        # Group by type
-        for issue in continuity_issues:
-            issue_type = issue['type']
-            if issue_type not in summary['by_type']:
-                summary['by_type'][issue_type] = 0
-            summary['by_type'][issue_type] += 1
+        # Restrict comparisons to the most similar shots from other scenes
+        pairs = None
+        if parameters.get('top_k'):
+            pairs = similar_pairs(assets, top_k=int(parameters['top_k']))
         
-        # Prepare result
+        state = {'cursor': saved.get('cursor', 0)}
+        if streaming:
+            # Issues are stored as they are found, so only their count and
+            # summary are checkpointed
+            state['last_asset_id'] = saved.get('last_asset_id') or (assets[-1].asset_id if assets else None)
+            state['issue_count'] = saved.get('issue_count', 0)
+            state['summary'] = saved.get('summary') or build_summary([])
+        else:
+            state['asset_ids'] = [asset.get('asset_id') for asset in assets]
+            state['issues'] = saved.get('issues', [])
+        for key in ['shard_results', 'pass', 'usage']:
+            if key in saved:
+                state[key] = saved[key]
+        
+        checkpoint = AnalysisCheckpoint(self.db, analysis_ref, self.worker_id, state, self._cancel_requests,
+                                        every_pairs=int(parameters.get('checkpoint_every', CHECKPOINT_EVERY_PAIRS)))
+        if analysis.get('cancel_requested'):
+            checkpoint.stop_reason = 'cancelled'
+        if streaming:
+            issues = IssueStream(self.db, analysis_ref, state)
+            # Issues must be stored before a checkpoint that counts them
+            checkpoint.before_save = issues.flush
+        else:
+            issues = state['issues']
+        
+        # Process each asset pair for continuity issues. Budgeted and
+        # streaming runs stay in this process.
+        coverage = None
+        summary = None
+        workers = int(parameters.get('workers', 1) or 1)
+        checkpoint.start_heartbeat()
+        try:
+            if budget:
+                coverage = self._run_scheduled(assets, rules, pairs, budget, checkpoint, issues)
+            elif workers > 1 and not streaming:
+                issues, summary = self._run_sharded(assets, rules, pairs, parameters, workers, checkpoint)
+            else:
+                self._run_sequential(assets, rules, pairs, checkpoint, issues)
+        finally:
+            checkpoint.stop_heartbeat()
+        
+        if checkpoint.stop_reason == 'lease_lost':
+            # Another worker resumed this analysis; leave the record to it
+            return {'error': 'Analysis was taken over by another worker'}
+        
+        if streaming:
+            issues.flush()
+            continuity_issues, summary = [], state['summary']
+        else:
+            continuity_issues = issues
+            if summary is None:
+                summary = build_summary(continuity_issues)
+            # Store issues individually so exports can page through them
+            self._store_issues(analysis_ref, continuity_issues)
+        
+        if checkpoint.stop_reason == 'cancelled':
+            status = 'cancelled'
+        elif coverage and not coverage['complete']:
+            status = 'partial'
+        else:
+            status = 'completed'
+        
+        # Prepare result; streamed issues are only in the issues subcollection
         result = {
             'project_id': analysis['project_id'],
             'analysis_id': analysis_id,
+            'status': status,
             'timestamp': datetime.now().isoformat(),
             'continuity_issues': continuity_issues,
             'summary': summary
         }
+        if coverage:
+            result['coverage'] = coverage
         
         # Update analysis with results
-        analysis_ref.update({
-            'status': 'completed',
+        loader.update('analyses', analysis_id, {
+            'status': status,
             'completed_at': firestore.SERVER_TIMESTAMP,
-            'results': result
+            'results': result,
+            'lease': firestore.DELETE_FIELD,
+            'checkpoint': firestore.DELETE_FIELD
         })
+        self._cancel_requests.discard(analysis_id)
         
         return result
     
+    def _store_issues(self, analysis_ref, continuity_issues):
+        """Write issues to the analysis' issues subcollection in batches"""
+        issues_ref = analysis_ref.collection('issues')
+        batch = self.db.batch()
+        pending = 0
+        
+        for seq, issue in enumerate(continuity_issues):
+            batch.set(issues_ref.document(issue['issue_id']), dict(issue, seq=seq))
+            pending += 1
+            if pending == WRITE_BATCH_SIZE:
+                batch.commit()
+                batch = self.db.batch()
+                pending = 0
+        
+        if pending:
+            batch.commit()
+    
+    def _load_assets(self, analysis, asset_ids=None):
+        """Load the assets to analyze, optionally restricted to a saved order"""
+        # Copies, since features are attached to the asset dicts in place
+        media_assets = analysis.get('media_assets', [])
+        # Assets given by ID are read in one round trip
+        documents = loader_for(self.db).get_many('assets', [asset for asset in media_assets if isinstance(asset, str)])
+        assets = []
+        for asset in media_assets:
+            if isinstance(asset, str):
+                asset = documents.get(asset)
+            if asset:
+                assets.append(dict(asset))
+        if not media_assets:
+            # If no specific assets provided, get all project assets
+            query = self.db.collection('assets').where('project_id', '==', analysis['project_id'])
+            assets = [dict(asset) for asset in loader_for(self.db).stream('assets', query)]
+            # Stable order, so a resumed run rebuilds the same pair plan
+            assets.sort(key=lambda asset: asset.get('asset_id') or '')
+        
+        if asset_ids is not None:
+            by_id = {asset.get('asset_id'): asset for asset in assets}
+            assets = [by_id[asset_id] for asset_id in asset_ids if asset_id in by_id]
+        
+        return assets
+    
+    def _load_asset_records(self, analysis, last_asset_id=None, feature_names=None, page_size=ASSET_PAGE_SIZE):
+        """Load the assets to analyze as compact records, one page at a time
+
+        Project assets are read in asset ID order. A resumed run passes the
+        last asset ID its first run saw, so assets uploaded since do not
+        shift the pair plan. Documents are not kept in the request loader.
+        """
+        records = []
+        media_assets = analysis.get('media_assets', [])
+        if media_assets:
+            records = [AssetRecord.from_document(asset) for asset in media_assets if isinstance(asset, dict)]
+            asset_ids = [asset for asset in media_assets if isinstance(asset, str)]
+            for offset in range(0, len(asset_ids), page_size):
+                refs = [self.db.collection('assets').document(asset_id) for asset_id in asset_ids[offset:offset + page_size]]
+                records.extend(AssetRecord.from_document(doc.to_dict()) for doc in self.db.get_all(refs) if doc.exists)
+            self.feature_service.attach_features(records, feature_names)
+            return records
+        
+        query = self.db.collection('assets').where('project_id', '==', analysis['project_id'])
+        if last_asset_id is not None:
+            query = query.where('asset_id', '<=', last_asset_id)
+        query = query.order_by('asset_id').limit(page_size)
+        
+        last_seen = None
+        while True:
+            page_query = query.start_after({'asset_id': last_seen}) if last_seen is not None else query
+            page = [AssetRecord.from_document(doc.to_dict()) for doc in page_query.stream()]
+            self.feature_service.attach_features(page, feature_names)
+            records.extend(page)
+            if len(page) < page_size:
+                break
+            last_seen = page[-1].asset_id
+        
+        return records
+    
+    def _run_sequential(self, assets, rules, pairs, checkpoint, issues):
+        """Compare pairs in this process, adding issues found to issues
+
+        The cursor counts pairs done.
+        """
+        state = checkpoint.state
+        if pairs is None:
+            pairs = iter_cross_scene_pairs(assets)
+        
+        if checkpoint.stop_reason is None:
+            # Cheap rules run vectorized over blocks of pairs; model rules per pair
+            engine = RuleEngine(rules)
+            remaining = islice(pairs, state['cursor'], None)
+            for _, pair_issues in engine.iter_results(self.gemini_service, assets, remaining):
+                issues.extend(pair_issues)
+                state['cursor'] += 1
+                if checkpoint.advance():
+                    break
+    
+    def _run_sharded(self, assets, rules, pairs, parameters, workers, checkpoint):
+        """Fan the pair space out over a process pool; the cursor counts shards done"""
+        state = checkpoint.state
+        state.setdefault('shard_results', [])
+        shards = plan_shards(assets, parameters.get('max_pairs_per_shard', DEFAULT_MAX_PAIRS_PER_SHARD), pairs)
+        
+        if checkpoint.stop_reason is None:
+            executor = ShardedAnalysisExecutor(max_workers=workers)
+            # Results come back in shard order, so completed shards are a prefix
+            for result in executor.iter_results(assets, rules, shards[state['cursor']:]):
+                state['shard_results'].append(result)
+                state['cursor'] += 1
+                if checkpoint.advance(result['pair_count']):
+                    break
+        
+        return merge_shard_results(state['shard_results'])
+    
+    def _run_scheduled(self, assets, rules, pairs, budget, checkpoint, issues):
+        """Evaluate the most important comparisons first until the budget runs out
+
+        Local rules run over every pair first, since they make no model
+        calls. Model rules follow one priority tier at a time, each over the
+        pairs in scheduled order. The checkpoint tracks the current pass and
+        a cursor of pairs done within it. Returns the coverage report.
+        """
+        state = checkpoint.state
+        state.setdefault('pass', 0)
+        state['usage'] = budget.usage
+        passes = rule_passes(rules)
+        gemini_service = MeteredGeminiService(self.gemini_service, budget)
+        stop_reason = None
+        
+        while checkpoint.stop_reason is None and stop_reason is None and state['pass'] < len(passes):
+            _, pass_rules = passes[state['pass']]
+            engine = RuleEngine(pass_rules)
+            remaining = islice(iter_scheduled_pairs(assets, pairs), state['cursor'], None)
+            try:
+                for _, pair_issues in engine.iter_results(gemini_service, assets, remaining):
+                    issues.extend(pair_issues)
+                    state['cursor'] += 1
+                    if checkpoint.advance():
+                        break
+                    if budget.deadline_passed():
+                        stop_reason = 'deadline'
+                        break
+            except BudgetExhausted as e:
+                stop_reason = e.reason
+            
+            if checkpoint.stop_reason is None and stop_reason is None:
+                state['pass'] += 1
+                state['cursor'] = 0
+        
+        # Report how far each pass got
+        pairs_total = count_pairs(assets, pairs)
+        coverage = {
+            'pairs_total': pairs_total,
+            'passes': [],
+            'model_calls': budget.usage['model_calls'],
+            'estimated_tokens': budget.usage['estimated_tokens'],
+            'complete': state['pass'] >= len(passes),
+            'stop_reason': stop_reason
+        }
+        for index, (name, pass_rules) in enumerate(passes):
+            if index < state['pass']:
+                evaluated = pairs_total
+            elif index == state['pass']:
+                evaluated = state['cursor']
+            else:
+                evaluated = 0
+            coverage['passes'].append({
+                'name': name,
+                'rule_types': [rule.get('rule_type') for rule in pass_rules],
+                'pairs_evaluated': evaluated,
+                'coverage': round(evaluated / pairs_total, 4) if pairs_total else 1.0
+            })
+        
+        return coverage
+    
+    def cancel_analysis(self, analysis_id):
+        """Ask a running analysis to stop; it keeps the issues found so far
+
+        Returns (status, requested) as _request_cancel does.
+        """
+        analysis_ref = self.db.collection('analyses').document(analysis_id)
+        status, requested = _request_cancel(self.db.transaction(), analysis_ref)
+        if status == 'processing':
+            # Workers in this process notice before their next pair
+            self._cancel_requests.add(analysis_id)
+        return status, requested
+    
+    def resume_stale_analyses(self, limit=10):
+        """Resume processing analyses whose worker stopped renewing its lease"""
+        resumed = []
+        
+        try:
+            stale_docs = self.db.collection('analyses') \
+                .where('status', '==', 'processing') \
+                .where('lease.expires_at', '<', datetime.now(timezone.utc)) \
+                .limit(limit) \
+                .stream()
+            for doc in stale_docs:
+                result = self.run_analysis(doc.id)
+                if 'error' not in result:
+                    resumed.append(doc.id)
+            
+            return resumed
+        except Exception as e:
+            print(f"Error resuming analyses: {str(e)}")
+            return resumed
+    
     def get_project_analyses(self, project_id):
         """Get all analyses for a project"""
         analyses = []
         
         try:
-            analysis_docs = self.db.collection('analyses').where('project_id', '==', project_id).stream()
-            for doc in analysis_docs:
-                analysis = doc.to_dict()
+            query = self.db.collection('analyses').where('project_id', '==', project_id)
+            for analysis in loader_for(self.db).stream('analyses', query):
                 analyses.append(analysis)
             
             return analyses
@@ -146,10 +661,7 @@ class AnalysisService:
     def get_analysis(self, analysis_id):
         """Get a specific analysis by ID"""
         try:
-            analysis_ref = self.db.collection('analyses').document(analysis_id).get()
-            if analysis_ref.exists:
-                return analysis_ref.to_dict()
-            return None
+            return loader_for(self.db).get('analyses', analysis_id)
         except Exception as e:
             print(f"Error getting analysis: {str(e)}")
             return None
\ No newline at end of file
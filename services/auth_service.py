@@ -1,24 +1,15 @@
-import os
-import firebase_admin
-from firebase_admin import credentials, auth
+import uuid
+from firebase_admin import auth
 from firebase_admin import firestore
 
+from services.document_loader import loader_for
+from services.persistence import get_database, is_local
+
 class AuthService:
     def __init__(self):
-        # Initialize Firebase Admin SDK
-        # In a real application, this would use environment variables or secure secrets
-        # For demo purposes, we're just initializing with default settings
-        try:
-            firebase_admin.get_app()
-        except ValueError:
-            # Use application default credentials or service account
-            if os.path.exists('firebase-credentials.json'):
-                cred = credentials.Certificate('firebase-credentials.json')
-                firebase_admin.initialize_app(cred)
-            else:
-                firebase_admin.initialize_app()
-        
-        self.db = firestore.client()
+        # Firebase Admin SDK is initialized by the persistence layer unless
+        # the local backend is configured
+        self.db = get_database()
     
     def authenticate(self, email, password):
         """Authenticate a user with email and password
@@ -44,10 +35,7 @@ class AuthService:
     def get_user(self, user_id):
         """Get user details by ID"""
         try:
-            user_ref = self.db.collection('users').document(user_id).get()
-            if user_ref.exists:
-                return user_ref.to_dict()
-            return None
+            return loader_for(self.db).get('users', user_id)
         except Exception as e:
             print(f"Error getting user: {str(e)}")
             return None
@@ -55,22 +43,25 @@ class AuthService:
     def create_user(self, email, password, name):
         """Create a new user account"""
         try:
-            # Create user in Firebase Auth
-            user = auth.create_user(
-                email=email,
-                password=password,
-                display_name=name
-            )
+            # Create user in Firebase Auth; offline installs only keep the profile
+            if is_local():
+                user_id = str(uuid.uuid4())
+            else:
+                user_id = auth.create_user(
+                    email=email,
+                    password=password,
+                    display_name=name
+                ).uid
             
             # Store additional user data in Firestore
             user_data = {
-                'id': user.uid,
+                'id': user_id,
                 'email': email,
                 'name': name,
                 'created_at': firestore.SERVER_TIMESTAMP
             }
             
-            self.db.collection('users').document(user.uid).set(user_data)
+            loader_for(self.db).set('users', user_id, user_data)
             return user_data
         except Exception as e:
             print(f"Error creating user: {str(e)}")
@@ -0,0 +1,120 @@
+SEVERITIES = ['error', 'warning', 'info']
+
+
+class AssetRecord:
+    """Compact stand-in for an asset document holding only what analysis reads
+
+    Supports the dict-style get() used by the rules, so records and full
+    asset dicts can be analyzed interchangeably.
+    """
+    __slots__ = ('asset_id', 'scene_info', 'url', 'proxy', 'features')
+
+    def __init__(self, asset_id, scene_info=None, url=None, proxy=None, features=None):
+        self.asset_id = asset_id
+        self.scene_info = scene_info
+        self.url = url
+        self.proxy = proxy
+        self.features = features
+
+    @classmethod
+    def from_document(cls, asset):
+        scene_number = (asset.get('scene_info') or {}).get('scene_number')
+        proxy_url = (asset.get('proxy') or {}).get('url')
+        return cls(
+            asset.get('asset_id'),
+            scene_info={'scene_number': scene_number} if scene_number else None,
+            url=asset.get('url'),
+            proxy={'url': proxy_url} if proxy_url else None,
+            features=asset.get('features')
+        )
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        return default if value is None else value
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+
+def is_asset(value):
+    """True for asset dicts and records; analyses may also list bare asset IDs"""
+    return isinstance(value, (dict, AssetRecord))
+
+
+def get_scene_number(asset):
+    """Return the scene number an asset belongs to, if any"""
+    return asset.get('scene_info', {}).get('scene_number')
+
+
+def media_url(asset):
+    """URL to decode an asset from: its low-resolution proxy when one exists"""
+    return (asset.get('proxy') or {}).get('url') or asset.get('url')
+
+
+def get_indexed_objects(asset):
+    """Return the objects detected at ingest time, or None if not indexed"""
+    return asset.get('features', {}).get('objects')
+
+
+def iter_cross_scene_pairs(assets):
+    """Yield (i, j) index pairs, i < j, of assets from different scenes"""
+    for i, asset1 in enumerate(assets):
+        scene1 = get_scene_number(asset1)
+        if not scene1:
+            continue
+        for j in range(i + 1, len(assets)):
+            scene2 = get_scene_number(assets[j])
+            if scene2 and scene1 != scene2:
+                yield i, j
+
+
+def meets_severity_threshold(severity, threshold):
+    """True if severity is at least as severe as threshold; no threshold passes all"""
+    if threshold not in SEVERITIES or severity not in SEVERITIES:
+        return True
+    return SEVERITIES.index(severity) <= SEVERITIES.index(threshold)
+
+
+def count_meeting_threshold(summary, threshold):
+    """Number of issues in a summary at least as severe as threshold"""
+    by_severity = (summary or {}).get('by_severity') or {}
+    return sum(count for severity, count in by_severity.items() if meets_severity_threshold(severity, threshold))
+
+
+class SummaryBuilder:
+    """Counts issues by severity and by type as they are produced"""
+
+    def __init__(self, summary=None):
+        self.summary = summary or {
+            'total_issues': 0,
+            'by_severity': {severity: 0 for severity in SEVERITIES},
+            'by_type': {}
+        }
+
+    def add(self, issue):
+        self.summary['total_issues'] += 1
+        severity = issue['severity']
+        if severity in self.summary['by_severity']:
+            self.summary['by_severity'][severity] += 1
+        by_type = self.summary['by_type']
+        by_type[issue['type']] = by_type.get(issue['type'], 0) + 1
+
+
+def build_summary(continuity_issues):
+    """Count issues by severity and by type"""
+    builder = SummaryBuilder()
+    for issue in continuity_issues:
+        builder.add(issue)
+    return builder.summary
+
+
+def merge_summaries(summaries):
+    """Combine partial summaries into one"""
+    merged = build_summary([])
+    for summary in summaries:
+        merged['total_issues'] += summary['total_issues']
+        for severity, count in summary['by_severity'].items():
+            merged['by_severity'][severity] = merged['by_severity'].get(severity, 0) + count
+        for issue_type, count in summary['by_type'].items():
+            merged['by_type'][issue_type] = merged['by_type'].get(issue_type, 0) + count
+    return merged
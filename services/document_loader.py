@@ -0,0 +1,260 @@
+import threading
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from firebase_admin import firestore
+
+_current_loader = ContextVar('document_loader', default=None)
+
+# Write transforms whose result is only known to the server
+_SERVER_TRANSFORMS = (firestore.Increment, firestore.ArrayUnion, firestore.ArrayRemove)
+
+
+class DeferredDocument:
+    """A pending point read; all pending reads are fetched together"""
+
+    def __init__(self, loader, collection, doc_id):
+        self.loader = loader
+        self.key = (collection, doc_id)
+
+    def result(self):
+        self.loader.dispatch()
+        return self.loader.cache.get(self.key)
+
+
+class DocumentLoader:
+    """Request-scoped identity map and batching loader for Firestore documents
+
+    Each document is read at most once per request. Reads queued with defer()
+    are fetched in a single get_all round trip, and documents written through
+    the loader are served from memory afterwards. Returned dicts are shared
+    within the request, so callers must not mutate them. Round trips are
+    counted by the CountedClient the services' database is wrapped in.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.cache = {}
+        self.pending = []
+        # Documents this request wrote with set(), i.e. created
+        self.created = set()
+        self.round_trips = 0
+        self.reads = 0
+        self.hits = 0
+
+    def get(self, collection, doc_id):
+        """Read one document, or None if it does not exist"""
+        key = (collection, doc_id)
+        if key in self.cache:
+            self.hits += 1
+            return self.cache[key]
+
+        snapshot = self.db.collection(collection).document(doc_id).get()
+        self.reads += 1
+        self.cache[key] = snapshot.to_dict() if snapshot.exists else None
+        return self.cache[key]
+
+    def peek(self, collection, doc_id):
+        """Return a document already known to this request, without reading"""
+        return self.cache.get((collection, doc_id))
+
+    def defer(self, collection, doc_id):
+        """Queue a point read to be batched with other deferred reads"""
+        key = (collection, doc_id)
+        if key not in self.cache and key not in self.pending:
+            self.pending.append(key)
+        return DeferredDocument(self, collection, doc_id)
+
+    def get_many(self, collection, doc_ids):
+        """Read several documents in one round trip, keyed by ID"""
+        deferred = [self.defer(collection, doc_id) for doc_id in doc_ids]
+        return {item.key[1]: item.result() for item in deferred}
+
+    def dispatch(self):
+        """Fetch all queued reads with a single get_all"""
+        if not self.pending:
+            return
+
+        keys, self.pending = self.pending, []
+        refs = [self.db.collection(collection).document(doc_id) for collection, doc_id in keys]
+        found = {}
+        for snapshot in self.db.get_all(refs):
+            found[snapshot.reference.path] = snapshot.to_dict() if snapshot.exists else None
+        self.reads += len(keys)
+
+        for (collection, doc_id), ref in zip(keys, refs):
+            self.cache[(collection, doc_id)] = found.get(ref.path)
+
+    def stream(self, collection, query):
+        """Run a query and remember every returned document"""
+        documents = []
+        for snapshot in query.stream():
+            document = snapshot.to_dict()
+            self.cache[(collection, snapshot.id)] = document
+            documents.append(document)
+        self.reads += len(documents)
+        return documents
+
+    def set(self, collection, doc_id, data):
+        """Write a document and keep it for later reads in this request"""
+        self.db.collection(collection).document(doc_id).set(data)
+        self.created.add((collection, doc_id))
+        self.prime(collection, doc_id, data)
+
+    def update(self, collection, doc_id, fields):
+        """Update a document and apply the change to the cached copy"""
+        self.db.collection(collection).document(doc_id).update(fields)
+
+        key = (collection, doc_id)
+        cached = self.cache.get(key)
+        if cached is None:
+            return
+        if any('.' in field or isinstance(value, _SERVER_TRANSFORMS) for field, value in fields.items()):
+            # Nested paths and server transforms cannot be replayed locally
+            del self.cache[key]
+            return
+        merged = dict(cached)
+        for field, value in fields.items():
+            if value is firestore.DELETE_FIELD:
+                merged.pop(field, None)
+            else:
+                merged[field] = self._resolve(value)
+        self.cache[key] = merged
+
+    def delete(self, collection, doc_id):
+        """Delete a document and remember that it is gone"""
+        self.db.collection(collection).document(doc_id).delete()
+        self.cache[(collection, doc_id)] = None
+
+    def prime(self, collection, doc_id, data):
+        """Store a document this request already has, without reading it"""
+        if any(isinstance(value, _SERVER_TRANSFORMS) for value in data.values()):
+            self.cache.pop((collection, doc_id), None)
+            return
+        self.cache[(collection, doc_id)] = {field: self._resolve(value) for field, value in data.items()}
+
+    def record_round_trip(self, count=1):
+        """Count database round trips made during this request"""
+        self.round_trips += count
+
+    def _resolve(self, value):
+        # Close enough for reads within the same request
+        if value is firestore.SERVER_TIMESTAMP:
+            return datetime.now(timezone.utc)
+        return value
+
+
+def count_round_trips(count=1):
+    """Add round trips to the current request's loader, if there is one"""
+    loader = _current_loader.get()
+    if loader is not None:
+        loader.record_round_trip(count)
+
+
+def _unwrap(value):
+    if isinstance(value, _Counted):
+        return value._target
+    if isinstance(value, (list, tuple)):
+        return type(value)(_unwrap(item) for item in value)
+    return value
+
+
+# Calls that reach the database, by kind of wrapped object; writes on a
+# batch are buffered until commit
+_NETWORK_CALLS = {
+    'client': {'get_all', 'collections'},
+    'document': {'get', 'set', 'create', 'update', 'delete', 'collections'},
+    'query': {'get', 'stream', 'add', 'list_documents'},
+    'batch': {'commit'}
+}
+# Calls that return another object to wrap, with its kind
+_CHAINED_CALLS = {
+    'collection': 'query', 'collection_group': 'query', 'document': 'document',
+    'where': 'query', 'order_by': 'query', 'limit': 'query', 'limit_to_last': 'query',
+    'offset': 'query', 'select': 'query', 'start_at': 'query', 'start_after': 'query',
+    'end_at': 'query', 'end_before': 'query', 'count': 'query', 'batch': 'batch'
+}
+
+
+class _Counted:
+    """Proxy for a client object that counts the calls reaching the database"""
+
+    __slots__ = ('_target', '_kind')
+
+    def __init__(self, target, kind):
+        self._target = target
+        self._kind = kind
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not callable(value):
+            return value
+
+        network = name in _NETWORK_CALLS[self._kind]
+        chained = _CHAINED_CALLS.get(name)
+
+        def call(*args, **kwargs):
+            result = value(*_unwrap(args), **{key: _unwrap(item) for key, item in kwargs.items()})
+            if network:
+                count_round_trips()
+            if chained:
+                result = _Counted(result, chained)
+            return result
+
+        return call
+
+
+class CountedClient(_Counted):
+    """Database client that counts round trips against the current request
+
+    References, queries and batches obtained from it are wrapped too, and
+    unwrapped again when passed back to the client. Transactions are left
+    alone; persistence.transactional counts their begin and commit, and
+    reads in them go through wrapped references.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, client):
+        super().__init__(client, 'client')
+
+
+class LoaderMetrics:
+    """Round trip counts per route, aggregated across requests"""
+
+    def __init__(self):
+        self.routes = {}
+        self.lock = threading.Lock()
+
+    def record(self, route, loader):
+        with self.lock:
+            stats = self.routes.setdefault(route, {
+                'requests': 0, 'round_trips': 0, 'reads': 0, 'cache_hits': 0, 'max_round_trips': 0
+            })
+            stats['requests'] += 1
+            stats['round_trips'] += loader.round_trips
+            stats['reads'] += loader.reads
+            stats['cache_hits'] += loader.hits
+            stats['max_round_trips'] = max(stats['max_round_trips'], loader.round_trips)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                route: dict(stats, avg_round_trips=round(stats['round_trips'] / stats['requests'], 2))
+                for route, stats in self.routes.items()
+            }
+
+
+def begin_request(db):
+    """Install a fresh loader for the current request"""
+    loader = DocumentLoader(db)
+    return loader, _current_loader.set(loader)
+
+
+def end_request(token):
+    """Remove the current request's loader"""
+    _current_loader.reset(token)
+
+
+def loader_for(db):
+    """The current request's loader, or a throwaway one outside requests"""
+    return _current_loader.get() or DocumentLoader(db)
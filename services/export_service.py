@@ -0,0 +1,192 @@
+import io
+import csv
+import json
+import html
+
+from services.persistence import get_database
+
+ISSUE_PAGE_SIZE = 500
+ROWS_PER_CHUNK = 200
+
+CSV_COLUMNS = [
+    'issue_id', 'type', 'severity', 'description', 'affected_assets',
+    'affected_scenes', 'frames', 'confidence_score', 'suggested_resolution'
+]
+
+REPORT_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; margin: 2em; }}
+table {{ border-collapse: collapse; width: 100%; }}
+th, td {{ border: 1px solid #ccc; padding: 4px 8px; text-align: left; vertical-align: top; }}
+td img {{ max-width: 160px; max-height: 90px; }}
+.error {{ color: #b00020; }}
+.warning {{ color: #b26a00; }}
+@media print {{ tr {{ page-break-inside: avoid; }} }}
+</style>
+</head>
+<body>
+"""
+
+
+class ExportService:
+    def __init__(self):
+        self.db = get_database()
+
+    def iter_issues(self, analysis, page_size=ISSUE_PAGE_SIZE):
+        """Yield the issues of an analysis, paging them from storage
+
+        Issues live in the analysis' issues subcollection ordered by seq.
+        Analyses stored before the subcollection existed fall back to the
+        issue list in their results.
+        """
+        issues_ref = self.db.collection('analyses').document(analysis['id']).collection('issues')
+        last_seq = None
+        found_any = False
+
+        while True:
+            query = issues_ref.order_by('seq').limit(page_size)
+            if last_seq is not None:
+                query = query.start_after({'seq': last_seq})
+
+            page = [doc.to_dict() for doc in query.stream()]
+            for issue in page:
+                found_any = True
+                yield issue
+            if len(page) < page_size:
+                break
+            last_seq = page[-1]['seq']
+
+        if not found_any:
+            for issue in (analysis.get('results') or {}).get('continuity_issues', []):
+                yield issue
+
+    def stream_csv(self, analysis):
+        """Yield the issues of an analysis as CSV text chunks"""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(CSV_COLUMNS)
+
+        rows = 0
+        for issue in self.iter_issues(analysis):
+            writer.writerow([self._csv_value(issue.get(column)) for column in CSV_COLUMNS])
+            rows += 1
+            if rows % ROWS_PER_CHUNK == 0:
+                yield self._drain(buffer)
+
+        yield self._drain(buffer)
+
+    def stream_jsonl(self, analysis):
+        """Yield the issues of an analysis as JSON Lines chunks"""
+        lines = []
+        for issue in self.iter_issues(analysis):
+            issue = {key: value for key, value in issue.items() if key != 'seq'}
+            lines.append(json.dumps(issue, default=str))
+            if len(lines) == ROWS_PER_CHUNK:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+    def stream_html_report(self, analysis, project):
+        """Render the continuity report incrementally as HTML
+
+        Frames are referenced through asset thumbnails rather than embedded,
+        and the page carries print styles so it can be saved as PDF.
+        """
+        results = analysis.get('results') or {}
+        summary = results.get('summary', {})
+        title = f"Continuity Report - {project.get('name', '')}"
+
+        yield REPORT_HEAD.format(title=html.escape(title))
+        yield f"<h1>{html.escape(title)}</h1>\n"
+        yield (
+            f"<p>Analysis {html.escape(str(analysis.get('id')))} "
+            f"({html.escape(str(analysis.get('status')))}), "
+            f"generated {html.escape(str(results.get('timestamp', '')))}</p>\n"
+        )
+
+        yield "<h2>Summary</h2>\n<ul>\n"
+        yield f"<li>Total issues: {summary.get('total_issues', 0)}</li>\n"
+        for severity, count in summary.get('by_severity', {}).items():
+            yield f"<li>{html.escape(severity.title())}: {count}</li>\n"
+        for issue_type, count in summary.get('by_type', {}).items():
+            yield f"<li>{html.escape(issue_type)}: {count}</li>\n"
+        yield "</ul>\n"
+
+        yield (
+            "<h2>Issues</h2>\n<table>\n<tr><th>Severity</th><th>Type</th><th>Description</th>"
+            "<th>Scenes</th><th>Frames</th><th>Confidence</th><th>Resolution</th></tr>\n"
+        )
+
+        thumbnails = {}
+        rows = []
+        for issue in self.iter_issues(analysis):
+            rows.append(issue)
+            if len(rows) == ROWS_PER_CHUNK:
+                yield self._render_rows(rows, thumbnails)
+                rows = []
+        if rows:
+            yield self._render_rows(rows, thumbnails)
+
+        yield "</table>\n</body>\n</html>\n"
+
+    def _render_rows(self, issues, thumbnails):
+        """Render a page of issues as table rows"""
+        self._load_thumbnails(issues, thumbnails)
+
+        parts = []
+        for issue in issues:
+            frames = ''.join(
+                f'<img src="{html.escape(thumbnails[asset_id], quote=True)}" alt="" loading="lazy">'
+                for asset_id in issue.get('affected_assets', []) if thumbnails.get(asset_id)
+            )
+            severity = html.escape(str(issue.get('severity', '')))
+            parts.append(
+                f'<tr><td class="{severity}">{severity}</td>'
+                f"<td>{html.escape(str(issue.get('type', '')))}</td>"
+                f"<td>{html.escape(str(issue.get('description', '')))}</td>"
+                f"<td>{html.escape(', '.join(str(scene) for scene in issue.get('affected_scenes', [])))}</td>"
+                f"<td>{frames}{html.escape(', '.join(str(frame) for frame in issue.get('frames', [])))}</td>"
+                f"<td>{issue.get('confidence_score', '')}</td>"
+                f"<td>{html.escape(str(issue.get('suggested_resolution', '')))}</td></tr>\n"
+            )
+        return ''.join(parts)
+
+    def _load_thumbnails(self, issues, thumbnails):
+        """Look up thumbnail URLs for assets not seen in earlier pages"""
+        missing = {
+            asset_id for issue in issues for asset_id in issue.get('affected_assets', [])
+            if asset_id and asset_id not in thumbnails
+        }
+        if not missing:
+            return
+
+        try:
+            refs = [self.db.collection('assets').document(asset_id) for asset_id in missing]
+            for doc in self.db.get_all(refs):
+                asset = doc.to_dict() if doc.exists else {}
+                thumbnail = asset.get('thumbnail_url')
+                if not thumbnail and asset.get('type') == 'image':
+                    thumbnail = asset.get('url')
+                thumbnails[doc.id] = thumbnail
+        except Exception as e:
+            print(f"Error loading thumbnails: {str(e)}")
+
+        for asset_id in missing:
+            thumbnails.setdefault(asset_id, None)
+
+    def _csv_value(self, value):
+        if isinstance(value, (list, tuple)):
+            return ';'.join(str(item) for item in value)
+        return '' if value is None else value
+
+    def _drain(self, buffer):
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        return chunk
@@ -0,0 +1,265 @@
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import requests
+from firebase_admin import firestore
+
+from services.gemini_service import GeminiService
+from services.continuity_checks import media_url, is_asset
+from services.persistence import get_database
+
+# Bump an extractor's version whenever its output changes; stored features
+# with an older version are recomputed on the next index pass
+EXTRACTOR_VERSIONS = {
+    'objects': 1,
+    'color_histogram': 1,
+    'perceptual_hash': 1,
+    'clothing_colors': 1,
+    'luminance': 1,
+    'lighting': 1,
+    'color_temperature': 1
+}
+
+
+def extract_color_histogram(frame):
+    """8x4x4 HSV histogram, L1-normalized"""
+    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+    hist = cv2.calcHist([hsv], [0, 1, 2], None, [8, 4, 4], [0, 180, 0, 256, 0, 256]).flatten()
+    total = hist.sum()
+    if total > 0:
+        hist /= total
+    return [round(float(v), 6) for v in hist]
+
+
+def extract_perceptual_hash(frame):
+    """64-bit DCT perceptual hash as a hex string"""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8]
+    bits = (low > np.median(low)).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return f"{value:016x}"
+
+
+def extract_clothing_colors(frame, k=3):
+    """Dominant colors of the center of frame, where subjects usually stand"""
+    height, width = frame.shape[:2]
+    region = frame[height // 4:height, width // 4:3 * width // 4]
+    pixels = cv2.resize(region, (64, 64), interpolation=cv2.INTER_AREA).reshape(-1, 3).astype(np.float32)
+
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 10, 1.0)
+    _, labels, centers = cv2.kmeans(pixels, k, None, criteria, 3, cv2.KMEANS_PP_CENTERS)
+    counts = np.bincount(labels.flatten(), minlength=k)
+
+    colors = []
+    for index in np.argsort(-counts):
+        b, g, r = centers[index]
+        colors.append({
+            'rgb': [int(r), int(g), int(b)],
+            'share': round(float(counts[index]) / len(labels), 4)
+        })
+    return colors
+
+
+def extract_luminance(frame):
+    """Summary statistics of frame luminance"""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    p5, p50, p95 = np.percentile(gray, [5, 50, 95])
+    return {
+        'mean': round(float(gray.mean()), 3),
+        'std': round(float(gray.std()), 3),
+        'p5': round(float(p5), 3),
+        'median': round(float(p50), 3),
+        'p95': round(float(p95), 3)
+    }
+
+
+def extract_lighting(frame):
+    """Key light direction and strength from the mean luminance gradient
+
+    The direction is a unit vector in image coordinates pointing from the
+    darker to the brighter side of the frame.
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY).astype(np.float32) / 255.0
+    small = cv2.resize(gray, (64, 64), interpolation=cv2.INTER_AREA)
+    smooth = cv2.GaussianBlur(small, (0, 0), 4)
+    gx = float(cv2.Sobel(smooth, cv2.CV_32F, 1, 0).mean())
+    gy = float(cv2.Sobel(smooth, cv2.CV_32F, 0, 1).mean())
+    strength = float(np.hypot(gx, gy))
+
+    direction = [gx / strength, gy / strength] if strength > 0 else [0.0, 0.0]
+    return {
+        'direction': [round(v, 6) for v in direction],
+        'strength': round(strength, 6),
+        'intensity': round(float(gray.mean()) * 255.0, 3)
+    }
+
+
+def extract_color_temperature(frame):
+    """Correlated color temperature of the mean frame color (McCamy's formula)"""
+    bgr = frame.reshape(-1, 3).astype(np.float32) / 255.0
+    # Undo the sRGB transfer curve before averaging in linear light
+    linear = np.where(bgr <= 0.04045, bgr / 12.92, ((bgr + 0.055) / 1.055) ** 2.4)
+    b, g, r = linear.mean(axis=0)
+
+    x_ = 0.4124 * r + 0.3576 * g + 0.1805 * b
+    y_ = 0.2126 * r + 0.7152 * g + 0.0722 * b
+    z_ = 0.0193 * r + 0.1192 * g + 0.9505 * b
+    total = x_ + y_ + z_
+    if total <= 0:
+        return None
+
+    x, y = x_ / total, y_ / total
+    n = (x - 0.3320) / (0.1858 - y)
+    kelvin = float(np.clip(449 * n ** 3 + 3525 * n ** 2 + 6823.3 * n + 5520.33, 1000, 40000))
+    return {
+        'kelvin': round(kelvin, 1),
+        'mired': round(1e6 / kelvin, 3)
+    }
+
+
+FRAME_EXTRACTORS = {
+    'color_histogram': extract_color_histogram,
+    'perceptual_hash': extract_perceptual_hash,
+    'clothing_colors': extract_clothing_colors,
+    'luminance': extract_luminance,
+    'lighting': extract_lighting,
+    'color_temperature': extract_color_temperature
+}
+
+
+class FeatureService:
+    def __init__(self, max_workers=2):
+        self.db = get_database()
+        self.gemini_service = GeminiService()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='feature-index')
+
+    def enqueue_asset(self, asset):
+        """Index an asset's features in the background"""
+        if not asset:
+            return None
+        return self.executor.submit(self.index_asset, asset)
+
+    def stale_extractors(self, feature_doc):
+        """List extractors whose stored output is missing or out of date"""
+        versions = (feature_doc or {}).get('versions', {})
+        return [name for name, version in EXTRACTOR_VERSIONS.items() if versions.get(name) != version]
+
+    def index_asset(self, asset, force=False):
+        """Compute and persist the features of one asset"""
+        try:
+            asset_id = asset['asset_id']
+            feature_ref = self.db.collection('asset_features').document(asset_id)
+            existing = feature_ref.get()
+            feature_doc = existing.to_dict() if existing.exists else {}
+
+            pending = list(EXTRACTOR_VERSIONS) if force else self.stale_extractors(feature_doc)
+            if not pending:
+                return feature_doc
+
+            features = dict(feature_doc.get('features', {}))
+            versions = dict(feature_doc.get('versions', {}))
+
+            frame_extractors = [name for name in pending if name in FRAME_EXTRACTORS]
+            if frame_extractors:
+                frame = self._load_frame(asset)
+                if frame is not None:
+                    for name in frame_extractors:
+                        features[name] = FRAME_EXTRACTORS[name](frame)
+                        versions[name] = EXTRACTOR_VERSIONS[name]
+
+            if 'objects' in pending:
+                features['objects'] = self.gemini_service.identify_objects(media_url(asset))
+                versions['objects'] = EXTRACTOR_VERSIONS['objects']
+
+            feature_doc = {
+                'asset_id': asset_id,
+                'project_id': asset.get('project_id'),
+                'features': features,
+                'versions': versions,
+                'indexed_at': firestore.SERVER_TIMESTAMP
+            }
+            feature_ref.set(feature_doc)
+
+            return feature_doc
+        except Exception as e:
+            print(f"Error indexing asset features: {str(e)}")
+            return None
+
+    def reindex_project(self, project_id):
+        """Queue every project asset whose features are missing or stale"""
+        futures = []
+        try:
+            asset_docs = self.db.collection('assets').where('project_id', '==', project_id).stream()
+            for doc in asset_docs:
+                futures.append(self.enqueue_asset(doc.to_dict()))
+            return futures
+        except Exception as e:
+            print(f"Error reindexing project features: {str(e)}")
+            return futures
+
+    def get_features(self, asset_ids):
+        """Fetch indexed features for a list of assets, keyed by asset ID"""
+        if not asset_ids:
+            return {}
+
+        features = {}
+        try:
+            refs = [self.db.collection('asset_features').document(asset_id) for asset_id in asset_ids]
+            for doc in self.db.get_all(refs):
+                if doc.exists:
+                    feature_doc = doc.to_dict()
+                    features[feature_doc['asset_id']] = feature_doc
+            return features
+        except Exception as e:
+            print(f"Error getting asset features: {str(e)}")
+            return features
+
+    def attach_features(self, assets, names=None):
+        """Attach up-to-date indexed features to assets in place
+
+        names, if given, limits which features are attached.
+        """
+        asset_ids = [asset.get('asset_id') for asset in assets if is_asset(asset) and asset.get('asset_id')]
+        indexed = self.get_features(asset_ids)
+
+        for asset in assets:
+            if not is_asset(asset):
+                continue
+            feature_doc = indexed.get(asset.get('asset_id'))
+            if not feature_doc:
+                continue
+            versions = feature_doc.get('versions', {})
+            asset['features'] = {
+                name: value for name, value in feature_doc.get('features', {}).items()
+                if versions.get(name) == EXTRACTOR_VERSIONS.get(name) and (names is None or name in names)
+            }
+
+        return assets
+
+    def _load_frame(self, asset):
+        """Decode a representative BGR frame of an asset, from its proxy if any"""
+        url = media_url(asset)
+        if not url:
+            return None
+
+        if asset.get('type') == 'video':
+            # OpenCV streams from the URL through its FFmpeg backend
+            capture = cv2.VideoCapture(url)
+            try:
+                frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+                if frame_count > 0:
+                    capture.set(cv2.CAP_PROP_POS_FRAMES, frame_count // 2)
+                ok, frame = capture.read()
+                return frame if ok else None
+            finally:
+                capture.release()
+
+        response = requests.get(url, timeout=30)
+        if response.status_code != 200:
+            print(f"Error downloading asset {asset.get('asset_id')}: {response.status_code}")
+            return None
+        data = np.frombuffer(response.content, dtype=np.uint8)
+        return cv2.imdecode(data, cv2.IMREAD_COLOR)
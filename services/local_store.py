@@ -0,0 +1,643 @@
+"""Local persistence: documents in SQLite, blobs on the filesystem
+
+LocalDatabase and LocalBucket implement the subset of the Firestore and
+Cloud Storage client APIs the services use, so the app can run without a
+network connection (e.g. on a laptop on set). Every write is also recorded
+in an outbox, which FirebaseSync replays against Firebase once a connection
+is available:
+
+    python -m services.local_store sync
+"""
+import os
+import sys
+import copy
+import json
+import shutil
+import random
+import string
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from firebase_admin import firestore
+
+DEFAULT_DATABASE_PATH = 'data/continuity.db'
+DEFAULT_BLOB_ROOT = 'data/blobs'
+DEFAULT_MEDIA_URL = 'http://localhost:5000/media'
+SYNC_BATCH_SIZE = 500
+
+# Fields with an expression index; queries on them never scan a collection
+INDEXED_FIELDS = ['project_id', 'created_by', 'user_id', 'scene_info.scene_number']
+# Array fields whose elements are indexed for array_contains
+INDEXED_ARRAYS = ['members']
+
+_TIMESTAMP_KEY = '__ts__'
+_AUTO_ID_CHARS = string.ascii_letters + string.digits
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    path TEXT PRIMARY KEY,
+    collection TEXT NOT NULL,
+    doc_id TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_collection ON documents (collection, doc_id);
+CREATE TABLE IF NOT EXISTS array_members (
+    path TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (field, value, path)
+);
+CREATE INDEX IF NOT EXISTS array_members_path ON array_members (path);
+CREATE TABLE IF NOT EXISTS sync_outbox (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    op TEXT NOT NULL,
+    path TEXT NOT NULL,
+    data TEXT
+);
+"""
+
+
+def _json_path(field):
+    return '$' + ''.join(f'."{part}"' for part in field.split('.'))
+
+
+def _field_expression(field):
+    """SQL expression for a document field
+
+    Timestamps are stored as {"__ts__": ISO string} so they sort as text;
+    indexed fields are used verbatim so SQLite can match their indexes.
+    """
+    if field in INDEXED_FIELDS:
+        return f"json_extract(data, '{_json_path(field)}')"
+    return (
+        f"COALESCE(json_extract(data, '{_json_path(field)}.\"{_TIMESTAMP_KEY}\"'), "
+        f"json_extract(data, '{_json_path(field)}'))"
+    )
+
+
+def _timestamp_text(value):
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f+00:00')
+
+
+def _sql_value(value):
+    if isinstance(value, datetime):
+        return _timestamp_text(value)
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {_TIMESTAMP_KEY: _timestamp_text(value)}
+    if isinstance(value, dict):
+        return {key: _encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        if len(value) == 1 and _TIMESTAMP_KEY in value:
+            return datetime.fromisoformat(value[_TIMESTAMP_KEY])
+        return {key: _decode(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    return value
+
+
+def _apply_value(current, value, now):
+    """Resolve write sentinels against the current field value"""
+    if value is firestore.SERVER_TIMESTAMP:
+        return now
+    if isinstance(value, firestore.Increment):
+        return (current if isinstance(current, (int, float)) else 0) + value.value
+    if isinstance(value, firestore.ArrayUnion):
+        items = list(current) if isinstance(current, list) else []
+        return items + [item for item in value.values if item not in items]
+    if isinstance(value, firestore.ArrayRemove):
+        return [item for item in (current if isinstance(current, list) else []) if item not in value.values]
+    if isinstance(value, dict):
+        base = current if isinstance(current, dict) else {}
+        return {key: _apply_value(base.get(key), item, now) for key, item in value.items()
+                if item is not firestore.DELETE_FIELD}
+    return value
+
+
+def _merge(document, data, now):
+    """set(..., merge=True): merge nested maps into the existing document"""
+    merged = dict(document)
+    for key, value in data.items():
+        if value is firestore.DELETE_FIELD:
+            merged.pop(key, None)
+        elif isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value, now)
+        else:
+            merged[key] = _apply_value(merged.get(key), value, now)
+    return merged
+
+
+def _update(document, fields, now):
+    """update(): fields are dotted paths replacing the value they point at"""
+    updated = copy.deepcopy(document)
+    for field, value in fields.items():
+        parts = field.split('.')
+        target = updated
+        for part in parts[:-1]:
+            if not isinstance(target.get(part), dict):
+                target[part] = {}
+            target = target[part]
+        if value is firestore.DELETE_FIELD:
+            target.pop(parts[-1], None)
+        else:
+            target[parts[-1]] = _apply_value(target.get(parts[-1]), value, now)
+    return updated
+
+
+def _get_field(document, field):
+    value = document
+    for part in field.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def _split_path(path):
+    collection, _, doc_id = path.rpartition('/')
+    return collection, doc_id
+
+
+class LocalSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field):
+        return _get_field(self._data or {}, field)
+
+
+class LocalDocumentReference:
+    def __init__(self, db, path):
+        self.db = db
+        self.path = path
+        self.id = path.rpartition('/')[2]
+
+    def collection(self, name):
+        return LocalCollection(self.db, f"{self.path}/{name}")
+
+    def get(self, transaction=None, field_paths=None):
+        return LocalSnapshot(self, self.db.read(self.path))
+
+    def set(self, data, merge=False):
+        self.db.write([('set_merge' if merge else 'set', self.path, data)])
+
+    def update(self, fields):
+        self.db.write([('update', self.path, fields)])
+
+    def delete(self):
+        self.db.write([('delete', self.path, None)])
+
+
+class AggregationResult:
+    def __init__(self, alias, value):
+        self.alias = alias
+        self.value = value
+
+
+class LocalCountQuery:
+    def __init__(self, query, alias):
+        self.query = query
+        self.alias = alias
+
+    def get(self, transaction=None):
+        sql, params = self.query.to_sql('COUNT(*)', ordered=False)
+        count = self.query.db.connection().execute(sql, params).fetchone()[0]
+        return [[AggregationResult(self.alias, count)]]
+
+
+class LocalQuery:
+    """Firestore-style query compiled to a single SQL statement"""
+
+    def __init__(self, db, collection, filters=(), orders=(), limit_count=None, cursor=None):
+        self.db = db
+        self.collection_path = collection
+        self.filters = list(filters)
+        self.orders = list(orders)
+        self.limit_count = limit_count
+        self.cursor = cursor
+
+    def _copy(self, **changes):
+        values = {
+            'filters': self.filters, 'orders': self.orders,
+            'limit_count': self.limit_count, 'cursor': self.cursor
+        }
+        values.update(changes)
+        return LocalQuery(self.db, self.collection_path, **values)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self.filters + [(field, op, value)])
+
+    def order_by(self, field, direction='ASCENDING'):
+        return self._copy(orders=self.orders + [(field, direction)])
+
+    def limit(self, count):
+        return self._copy(limit_count=count)
+
+    def start_after(self, values):
+        if isinstance(values, LocalSnapshot):
+            values = {field: values.get(field) for field, _ in self.orders}
+        return self._copy(cursor=values)
+
+    def count(self, alias='count'):
+        return LocalCountQuery(self, alias)
+
+    def to_sql(self, columns, ordered=True):
+        # With an indexed array filter, start from its matching paths; the unary
+        # + keeps SQLite from scanning the collection index to avoid a sort
+        by_array = any(op == 'array_contains' and field in INDEXED_ARRAYS for field, op, _ in self.filters)
+        clauses = ['+collection = ?' if by_array else 'collection = ?']
+        params = [self.collection_path]
+
+        for field, op, value in self.filters:
+            expression = _field_expression(field)
+            if op == '==' and value is None:
+                clauses.append(f"{expression} IS NULL")
+            elif op in ('==', '!=', '<', '<=', '>', '>='):
+                clauses.append(f"{expression} {'=' if op == '==' else op} ?")
+                params.append(_sql_value(value))
+            elif op in ('in', 'not-in'):
+                placeholders = ', '.join('?' for _ in value) or 'NULL'
+                clauses.append(f"{expression} {'IN' if op == 'in' else 'NOT IN'} ({placeholders})")
+                params.extend(_sql_value(item) for item in value)
+            elif op == 'array_contains' and field in INDEXED_ARRAYS:
+                clauses.append("path IN (SELECT path FROM array_members WHERE field = ? AND value = ?)")
+                params.extend([field, json.dumps(_encode(value))])
+            elif op == 'array_contains':
+                clauses.append(f"EXISTS (SELECT 1 FROM json_each(data, '{_json_path(field)}') WHERE value = ?)")
+                params.append(_sql_value(value))
+            else:
+                raise ValueError(f"Unsupported query operator: {op}")
+
+        # Like Firestore, documents without an order_by field are left out
+        for field, _ in self.orders:
+            clauses.append(f"{_field_expression(field)} IS NOT NULL")
+
+        if self.cursor is not None and self.orders:
+            # Tuple comparison "after the cursor" honoring each direction
+            alternatives = []
+            for position, (field, direction) in enumerate(self.orders):
+                terms = [f"{_field_expression(previous)} = ?" for previous, _ in self.orders[:position]]
+                terms.append(f"{_field_expression(field)} {'<' if direction == 'DESCENDING' else '>'} ?")
+                alternatives.append('(' + ' AND '.join(terms) + ')')
+                params.extend(_sql_value(self.cursor.get(previous)) for previous, _ in self.orders[:position])
+                params.append(_sql_value(self.cursor.get(field)))
+            clauses.append('(' + ' OR '.join(alternatives) + ')')
+
+        sql = f"SELECT {columns} FROM documents WHERE {' AND '.join(clauses)}"
+        if ordered:
+            orders = [
+                f"{_field_expression(field)} {'DESC' if direction == 'DESCENDING' else 'ASC'}"
+                for field, direction in self.orders
+            ]
+            sql += ' ORDER BY ' + ', '.join(orders + ['doc_id'])
+            if self.limit_count is not None:
+                sql += ' LIMIT ?'
+                params.append(int(self.limit_count))
+        return sql, params
+
+    def stream(self, transaction=None):
+        sql, params = self.to_sql('path, data')
+        rows = self.db.connection().execute(sql, params).fetchall()
+        for path, data in rows:
+            yield LocalSnapshot(LocalDocumentReference(self.db, path), _decode(json.loads(data)))
+
+    def get(self, transaction=None):
+        return list(self.stream())
+
+
+class LocalCollection(LocalQuery):
+    def __init__(self, db, path):
+        super().__init__(db, path)
+        self.id = path.rpartition('/')[2]
+
+    def document(self, doc_id=None):
+        if doc_id is None:
+            doc_id = ''.join(random.choice(_AUTO_ID_CHARS) for _ in range(20))
+        return LocalDocumentReference(self.db, f"{self.collection_path}/{doc_id}")
+
+
+class LocalWriteBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, reference, data, merge=False):
+        self.writes.append(('set_merge' if merge else 'set', reference.path, data))
+
+    def update(self, reference, fields):
+        self.writes.append(('update', reference.path, fields))
+
+    def delete(self, reference):
+        self.writes.append(('delete', reference.path, None))
+
+    def commit(self):
+        writes, self.writes = self.writes, []
+        self.db.write(writes)
+
+
+class LocalTransaction(LocalWriteBatch):
+    """Writes are applied together when the transactional function returns"""
+
+
+class LocalDatabase:
+    """Document store on SQLite mirroring the Firestore client API
+
+    Documents are JSON rows keyed by their path, so subcollections work
+    unchanged. Each thread gets its own connection; the database runs in
+    WAL mode so reads do not wait for writers.
+    """
+
+    def __init__(self, path=DEFAULT_DATABASE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        connection = self.connection()
+        connection.executescript(SCHEMA)
+        for field in INDEXED_FIELDS:
+            name = 'documents_' + field.replace('.', '_')
+            connection.execute(f"CREATE INDEX IF NOT EXISTS {name} ON documents (collection, {_field_expression(field)}, doc_id)")
+        connection.commit()
+
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def collection(self, name):
+        return LocalCollection(self, name)
+
+    def document(self, path):
+        return LocalDocumentReference(self, path)
+
+    def batch(self):
+        return LocalWriteBatch(self)
+
+    def transaction(self):
+        return LocalTransaction(self)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        references = list(references)
+        if not references:
+            return
+        documents = {}
+        paths = [reference.path for reference in references]
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            rows = self.connection().execute(
+                f"SELECT path, data FROM documents WHERE path IN ({', '.join('?' for _ in chunk)})", chunk
+            ).fetchall()
+            documents.update((path, _decode(json.loads(data))) for path, data in rows)
+        for reference in references:
+            yield LocalSnapshot(reference, documents.get(reference.path))
+
+    def read(self, path):
+        row = self.connection().execute("SELECT data FROM documents WHERE path = ?", (path,)).fetchone()
+        return _decode(json.loads(row[0])) if row else None
+
+    def run_transaction(self, function, transaction, *args, **kwargs):
+        """Run a transactional function with the database locked for writing"""
+        connection = self.connection()
+        with self._write_lock:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                result = function(transaction, *args, **kwargs)
+                self._apply(connection, transaction.writes)
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            finally:
+                transaction.writes = []
+        return result
+
+    def write(self, writes):
+        """Apply a list of (op, path, data) writes atomically"""
+        if not writes:
+            return
+        connection = self.connection()
+        with self._write_lock:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                self._apply(connection, writes)
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+
+    def _apply(self, connection, writes):
+        now = datetime.now(timezone.utc)
+        for op, path, data in writes:
+            row = connection.execute("SELECT data FROM documents WHERE path = ?", (path,)).fetchone()
+            current = _decode(json.loads(row[0])) if row else None
+
+            if op == 'delete':
+                connection.execute("DELETE FROM documents WHERE path = ?", (path,))
+                connection.execute("DELETE FROM array_members WHERE path = ?", (path,))
+                connection.execute("INSERT INTO sync_outbox (kind, op, path) VALUES ('document', 'delete', ?)", (path,))
+                continue
+
+            if op == 'update':
+                if current is None:
+                    raise KeyError(f"No document to update: {path}")
+                document = _update(current, data, now)
+            elif op == 'set_merge':
+                document = _merge(current or {}, data, now)
+            else:
+                document = _apply_value(None, data, now)
+
+            encoded = json.dumps(_encode(document))
+            collection, doc_id = _split_path(path)
+            connection.execute(
+                "INSERT INTO documents (path, collection, doc_id, data) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (path) DO UPDATE SET data = excluded.data",
+                (path, collection, doc_id, encoded)
+            )
+            connection.execute("DELETE FROM array_members WHERE path = ?", (path,))
+            for field in INDEXED_ARRAYS:
+                values = _get_field(document, field)
+                if isinstance(values, list):
+                    connection.executemany(
+                        "INSERT OR IGNORE INTO array_members (path, field, value) VALUES (?, ?, ?)",
+                        [(path, field, json.dumps(_encode(value))) for value in values]
+                    )
+            # The whole document is queued, so replaying the outbox is idempotent
+            connection.execute(
+                "INSERT INTO sync_outbox (kind, op, path, data) VALUES ('document', 'set', ?, ?)", (path, encoded)
+            )
+
+    def record_blob_change(self, op, storage_path):
+        with self._write_lock:
+            self.connection().execute(
+                "INSERT INTO sync_outbox (kind, op, path) VALUES ('blob', ?, ?)", (op, storage_path)
+            )
+
+
+class LocalBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.file_path = os.path.join(bucket.root, *name.split('/'))
+
+    @property
+    def public_url(self):
+        return f"{self.bucket.base_url}/{self.name}"
+
+    @property
+    def size(self):
+        return os.path.getsize(self.file_path) if os.path.exists(self.file_path) else None
+
+    def exists(self):
+        return os.path.exists(self.file_path)
+
+    def reload(self):
+        if not self.exists():
+            raise FileNotFoundError(self.name)
+
+    def upload_from_file(self, file, content_type=None):
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+        with open(self.file_path, 'wb') as out:
+            shutil.copyfileobj(file, out)
+        self.bucket.changed('upload', self.name)
+
+    def upload_from_filename(self, filename, content_type=None):
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+        shutil.copyfile(filename, self.file_path)
+        self.bucket.changed('upload', self.name)
+
+    def download_as_bytes(self, start=None, end=None):
+        """Read the blob, or bytes start..end inclusive as Cloud Storage does"""
+        with open(self.file_path, 'rb') as source:
+            source.seek(start or 0)
+            if end is None:
+                return source.read()
+            return source.read(end - (start or 0) + 1)
+
+    def delete(self):
+        os.remove(self.file_path)
+        self.bucket.changed('delete', self.name)
+
+
+class LocalBucket:
+    """Blob store on the local filesystem mirroring the Cloud Storage bucket API"""
+
+    def __init__(self, root=DEFAULT_BLOB_ROOT, base_url=DEFAULT_MEDIA_URL, database=None):
+        self.root = os.path.abspath(root)
+        self.base_url = base_url.rstrip('/')
+        self.database = database
+        os.makedirs(self.root, exist_ok=True)
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def get_blob(self, name):
+        blob = LocalBlob(self, name)
+        return blob if blob.exists() else None
+
+    def changed(self, op, name):
+        if self.database is not None:
+            self.database.record_blob_change(op, name)
+
+
+class FirebaseSync:
+    """Replays the local outbox against Firestore and Cloud Storage
+
+    Documents are written whole, in the order they were changed locally, so
+    the last local write wins. Links to local blobs anywhere in a document
+    are rewritten to the public URLs of their Cloud Storage copies. Synced
+    entries are removed from the outbox.
+    """
+
+    def __init__(self, database, bucket, remote_db, remote_bucket):
+        self.database = database
+        self.bucket = bucket
+        self.remote_db = remote_db
+        self.remote_bucket = remote_bucket
+
+    def pending(self):
+        return self.database.connection().execute("SELECT COUNT(*) FROM sync_outbox").fetchone()[0]
+
+    def push(self, batch_size=SYNC_BATCH_SIZE):
+        """Sync outbox entries in batches; returns how many were synced"""
+        synced = 0
+        connection = self.database.connection()
+        while True:
+            entries = connection.execute(
+                "SELECT seq, kind, op, path, data FROM sync_outbox ORDER BY seq LIMIT ?", (batch_size,)
+            ).fetchall()
+            if not entries:
+                return synced
+
+            batch = self.remote_db.batch()
+            for _, kind, op, path, data in entries:
+                if kind == 'blob':
+                    self._push_blob(op, path)
+                elif op == 'delete':
+                    batch.delete(self.remote_db.document(path))
+                else:
+                    batch.set(self.remote_db.document(path), self._remote_urls(_decode(json.loads(data))))
+            batch.commit()
+
+            with self.database._write_lock:
+                connection.execute("DELETE FROM sync_outbox WHERE seq <= ?", (entries[-1][0],))
+            synced += len(entries)
+
+    def _remote_urls(self, value):
+        """Replace local media URLs with the remote bucket's public URLs"""
+        if isinstance(value, dict):
+            return {key: self._remote_urls(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._remote_urls(item) for item in value]
+        prefix = f"{self.bucket.base_url}/"
+        if isinstance(value, str) and value.startswith(prefix):
+            return self.remote_bucket.blob(value[len(prefix):]).public_url
+        return value
+
+    def _push_blob(self, op, storage_path):
+        remote = self.remote_bucket.blob(storage_path)
+        local = self.bucket.blob(storage_path)
+        if op == 'delete':
+            if remote.exists():
+                remote.delete()
+        elif local.exists():
+            remote.upload_from_filename(local.file_path)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] != ['sync']:
+        print("Usage: python -m services.local_store sync")
+        sys.exit(1)
+
+    from firebase_admin import storage
+    from services.persistence import init_firebase, local_database, local_bucket
+
+    init_firebase()
+    sync = FirebaseSync(local_database(), local_bucket(), firestore.client(), storage.bucket())
+    print(f"Pending changes: {sync.pending()}")
+    print(f"Synced: {sync.push()}")
@@ -1,31 +1,109 @@
 import os
 import json
+import base64
 import requests
 from firebase_admin import firestore
 from datetime import datetime
 
+from services.continuity_checks import count_meeting_threshold
+from services.document_loader import loader_for
+from services.persistence import get_database, transactional
+
+# Transactions are limited to 500 writes; one is reserved for the counter
+MARK_READ_BATCH_SIZE = 499
+
+
+def encode_cursor(notification):
+    """Encode the position of a notification in the feed as an opaque cursor"""
+    timestamp = notification.get('timestamp')
+    position = {
+        'timestamp': timestamp.isoformat() if isinstance(timestamp, datetime) else timestamp,
+        'id': notification.get('id')
+    }
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decode a feed cursor into start_after field values"""
+    position = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    return {
+        'timestamp': datetime.fromisoformat(position['timestamp']),
+        'id': position['id']
+    }
+
+
+@transactional
+def _mark_read(transaction, db, notification_refs, counter_ref, user_id):
+    """Mark the user's unread notifications among refs read, in one commit"""
+    marked = 0
+    for snapshot in db.get_all(notification_refs, transaction=transaction):
+        if not snapshot.exists:
+            continue
+        notification = snapshot.to_dict()
+        # Verify user owns this notification and it is still unread
+        if notification.get('user_id') != user_id or notification.get('read'):
+            continue
+        transaction.update(snapshot.reference, {
+            'read': True,
+            'read_at': firestore.SERVER_TIMESTAMP
+        })
+        marked += 1
+
+    if marked:
+        transaction.set(counter_ref, {'unread_notifications': firestore.Increment(-marked)}, merge=True)
+    return marked
+
+
+@transactional
+def _seed_unread_counter(transaction, counter_ref, unread_query):
+    """Set the user's counter from a count of unread notifications, once
+
+    Increments can reach the counter before it is seeded, so the count, not
+    the counter, is the truth until then. Reading the counter in the
+    transaction makes a concurrent notification or mark-read retry it.
+    """
+    snapshot = counter_ref.get(transaction=transaction)
+    counter = snapshot.to_dict() if snapshot.exists else {}
+    if counter.get('seeded'):
+        return counter.get('unread_notifications', 0)
+
+    result = unread_query.count().get(transaction=transaction)
+    unread = int(result[0][0].value)
+    transaction.set(counter_ref, {'unread_notifications': unread, 'seeded': True}, merge=True)
+    return unread
+
 class NotificationService:
     def __init__(self):
-        self.db = firestore.client()
+        self.db = get_database()
     
     def send_analysis_complete(self, user_id, project_id, analysis_id):
-        """Send notification when analysis is complete"""
+        """Send notification when analysis is complete
+        
+        With a severity_threshold in the analysis' notification settings,
+        only analyses that found an issue at least that severe notify.
+        """
         try:
-            # Get user details
-            user_ref = self.db.collection('users').document(user_id).get()
-            if not user_ref.exists:
+            # Get user, project and analysis in one round trip, reusing
+            # documents this request has already read
+            loader = loader_for(self.db)
+            user_doc = loader.defer('users', user_id)
+            project_doc = loader.defer('projects', project_id)
+            analysis_doc = loader.defer('analyses', analysis_id)
+            
+            user = user_doc.result()
+            if not user:
                 print(f"User {user_id} not found")
                 return False
                 
-            user = user_ref.to_dict()
-            
-            # Get project details
-            project_ref = self.db.collection('projects').document(project_id).get()
-            if not project_ref.exists:
+            project = project_doc.result()
+            if not project:
                 print(f"Project {project_id} not found")
                 return False
-                
-            project = project_ref.to_dict()
+            
+            analysis = analysis_doc.result() or {}
+            threshold = (analysis.get('notification_settings') or {}).get('severity_threshold')
+            if threshold and not count_meeting_threshold((analysis.get('results') or {}).get('summary'), threshold):
+                return False
             
             # Create notification
             notification_id = self.db.collection('notifications').document().id
@@ -45,8 +123,11 @@ class NotificationService:
                 }
             }
             
-            # Store in Firestore
-            self.db.collection('notifications').document(notification_id).set(notification)
+            # Store in Firestore together with the user's unread counter
+            batch = self.db.batch()
+            batch.set(self.db.collection('notifications').document(notification_id), notification)
+            batch.set(self._counter_ref(user_id), {'unread_notifications': firestore.Increment(1)}, merge=True)
+            batch.commit()
             
             # Send email notification if configured
             if 'email' in user and os.getenv('ENABLE_EMAIL_NOTIFICATIONS') == 'true':
@@ -127,21 +208,27 @@ class NotificationService:
             print(f"Error sending Slack notification: {str(e)}")
             return False
     
-    def get_user_notifications(self, user_id, limit=10, offset=0):
-        """Get notifications for a user"""
+    def _counter_ref(self, user_id):
+        return self.db.collection('user_counters').document(user_id)
+    
+    def get_user_notifications(self, user_id, limit=10, cursor=None):
+        """Get a page of notifications for a user, newest first
+        
+        Pass the cursor of the last notification on the previous page to get
+        the next one; Firestore seeks to it instead of skipping documents.
+        """
         notifications = []
         
         try:
-            # Query notifications for user, ordered by timestamp
+            # Query notifications for user, ordered by timestamp then id
             query = self.db.collection('notifications') \
                 .where('user_id', '==', user_id) \
                 .order_by('timestamp', direction='DESCENDING') \
-                .limit(limit) \
-                .offset(offset)
-                
-            notification_docs = query.stream()
-            for doc in notification_docs:
-                notification = doc.to_dict()
+                .order_by('id', direction='DESCENDING')
+            if cursor:
+                query = query.start_after(decode_cursor(cursor))
+            
+            for notification in loader_for(self.db).stream('notifications', query.limit(limit)):
                 notifications.append(notification)
             
             return notifications
@@ -149,27 +236,65 @@ class NotificationService:
             print(f"Error getting notifications: {str(e)}")
             return []
     
+    def get_unread_count(self, user_id):
+        """Get the number of unread notifications from the user's counter"""
+        try:
+            counter = self._counter_ref(user_id).get()
+            if counter.exists and counter.to_dict().get('seeded'):
+                return max(counter.to_dict().get('unread_notifications', 0), 0)
+            
+            # Counter not backfilled yet: count once and seed it
+            unread_query = self.db.collection('notifications') \
+                .where('user_id', '==', user_id) \
+                .where('read', '==', False)
+            return max(_seed_unread_counter(self.db.transaction(), self._counter_ref(user_id), unread_query), 0)
+        except Exception as e:
+            print(f"Error getting unread count: {str(e)}")
+            return 0
+    
     def mark_notification_read(self, notification_id, user_id):
         """Mark a notification as read"""
+        return self.mark_notifications_read(user_id, [notification_id]) == 1
+    
+    def mark_notifications_read(self, user_id, notification_ids):
+        """Mark several notifications as read with batched writes"""
+        marked = 0
+        
         try:
-            # Get notification
-            notification_ref = self.db.collection('notifications').document(notification_id).get()
-            if not notification_ref.exists:
-                return False
-                
-            notification = notification_ref.to_dict()
-            
-            # Verify user owns this notification
-            if notification.get('user_id') != user_id:
-                return False
+            notification_ids = list(dict.fromkeys(notification_ids))
+            for start in range(0, len(notification_ids), MARK_READ_BATCH_SIZE):
+                refs = [
+                    self.db.collection('notifications').document(notification_id)
+                    for notification_id in notification_ids[start:start + MARK_READ_BATCH_SIZE]
+                ]
+                marked += _mark_read(self.db.transaction(), self.db, refs, self._counter_ref(user_id), user_id)
             
-            # Update notification
-            self.db.collection('notifications').document(notification_id).update({
-                'read': True,
-                'read_at': firestore.SERVER_TIMESTAMP
-            })
+            return marked
+        except Exception as e:
+            print(f"Error marking notifications read: {str(e)}")
+            return marked
+    
+    def mark_all_notifications_read(self, user_id):
+        """Mark every unread notification of a user as read"""
+        marked = 0
+        
+        try:
+            while True:
+                unread_docs = self.db.collection('notifications') \
+                    .where('user_id', '==', user_id) \
+                    .where('read', '==', False) \
+                    .limit(MARK_READ_BATCH_SIZE) \
+                    .stream()
+                refs = [doc.reference for doc in unread_docs]
+                if not refs:
+                    break
+                
+                page_marked = _mark_read(self.db.transaction(), self.db, refs, self._counter_ref(user_id), user_id)
+                marked += page_marked
+                if page_marked == 0:
+                    break
             
-            return True
+            return marked
         except Exception as e:
-            print(f"Error marking notification read: {str(e)}")
-            return False
\ No newline at end of file
+            print(f"Error marking all notifications read: {str(e)}")
+            return marked
@@ -0,0 +1,200 @@
+import re
+import time
+from itertools import combinations
+import numpy as np
+
+from services.continuity_checks import get_scene_number, is_asset
+from services.rule_engine import RULE_TYPES
+from services.shard_executor import bucket_by_scene
+from services.similarity_index import feature_vector
+
+PRIORITIES = ['high', 'medium', 'low']
+DEFAULT_PRIORITY = 'medium'
+
+# Gemini does not report usage for the calls we make, so spend is estimated:
+# an image costs a fixed number of input tokens, plus prompt and a typical answer
+ESTIMATED_TOKENS_PER_IMAGE = 258
+ESTIMATED_TOKENS_PER_CALL = 600
+
+
+class BudgetExhausted(Exception):
+    """Raised instead of a model call the analysis can no longer afford"""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def rule_priority(rule):
+    """A rule's priority, defaulting to medium"""
+    priority = str(rule.get('priority') or DEFAULT_PRIORITY).lower()
+    return priority if priority in PRIORITIES else DEFAULT_PRIORITY
+
+
+def rule_passes(rules):
+    """Split rules into passes: local rules first, then model rules by priority
+
+    Returns a list of (name, rules); passes without rules are left out.
+    """
+    known = [rule for rule in rules if rule.get('rule_type') in RULE_TYPES]
+    local = [rule for rule in known if RULE_TYPES[rule['rule_type']].local]
+
+    passes = [('local', local)] if local else []
+    for priority in PRIORITIES:
+        tier = [
+            rule for rule in known
+            if not RULE_TYPES[rule['rule_type']].local and rule_priority(rule) == priority
+        ]
+        if tier:
+            passes.append((priority, tier))
+    return passes
+
+
+def scene_sort_key(scene):
+    """Order scene numbers as in a script: 2 < 5 < 5A < 5B < 12"""
+    match = re.match(r'^(\d+)(.*)$', str(scene).strip())
+    if match:
+        return 0, int(match.group(1)), match.group(2).upper()
+    return 1, 0, str(scene).upper()
+
+
+def _scene_blocks(assets, pairs):
+    """Group the pair space by pair of scenes, adjacent scenes first
+
+    Returns a list of (left indices, right indices) for whole scene pairs, or
+    of explicit (i, j) lists when pairs is given; those are built lazily when
+    pairs can generate the pairs between two scenes itself.
+    """
+    buckets = bucket_by_scene(assets)
+    scenes = sorted(buckets, key=scene_sort_key)
+    rank = {scene: position for position, scene in enumerate(scenes)}
+
+    def position(scene):
+        return rank.get(scene, len(scenes))
+
+    def distance(scene_pair):
+        first, second = sorted(scene_pair, key=position)
+        return abs(position(second) - position(first)), position(first)
+
+    if pairs is None:
+        scene_pairs = sorted(combinations(scenes, 2), key=distance)
+        return [(buckets[first], buckets[second]) for first, second in scene_pairs]
+
+    if hasattr(pairs, 'between'):
+        # Generated pairs (SimilarPairs): build one scene pair's block at a time
+        scene_pairs = sorted(combinations(scenes, 2), key=distance)
+        return (list(pairs.between(buckets[first], buckets[second])) for first, second in scene_pairs)
+
+    groups = {}
+    for i, j in pairs:
+        # Keyed by the scene values themselves, as in rank; they may be ints
+        scene_pair = tuple(sorted((get_scene_number(assets[i]), get_scene_number(assets[j])), key=position))
+        groups.setdefault(scene_pair, []).append((i, j))
+    return [groups[scene_pair] for scene_pair in sorted(groups, key=distance)]
+
+
+def count_pairs(assets, pairs=None):
+    """Number of pairs iter_scheduled_pairs will yield"""
+    if pairs is not None:
+        return len(pairs)
+    return sum(len(left) * len(right) for left, right in _scene_blocks(assets, None))
+
+
+def iter_scheduled_pairs(assets, pairs=None):
+    """Yield cross-scene (i, j) pairs, i < j, most worth a model call first
+
+    Pairs from scenes adjacent in script order come first, since props and
+    wardrobe carry over most directly between them. Within a pair of scenes,
+    the most similar shots by indexed features come first; unindexed assets
+    score as neutral. The order only depends on the assets and their features.
+    """
+    vectors = np.zeros((len(assets), 0))
+    rows = {index: feature_vector(asset.get('features')) for index, asset in enumerate(assets) if is_asset(asset)}
+    rows = {index: row for index, row in rows.items() if row is not None}
+    if rows:
+        vectors = np.zeros((len(assets), len(next(iter(rows.values())))))
+        for index, row in rows.items():
+            vectors[index] = row
+
+    for block in _scene_blocks(assets, pairs):
+        if pairs is not None and not block:
+            continue
+        if pairs is None:
+            left_bucket, right_bucket = np.asarray(block[0]), np.asarray(block[1])
+            scores = (vectors[left_bucket] @ vectors[right_bucket].T).ravel()
+            first = np.repeat(left_bucket, len(right_bucket))
+            second = np.tile(right_bucket, len(left_bucket))
+        else:
+            pair_array = np.asarray(block, dtype=np.int64)
+            first, second = pair_array[:, 0], pair_array[:, 1]
+            scores = np.einsum('ij,ij->i', vectors[first], vectors[second])
+
+        left = np.minimum(first, second)
+        right = np.maximum(first, second)
+        for k in np.lexsort((right, left, -scores)):
+            yield int(left[k]), int(right[k])
+
+
+class AnalysisBudget:
+    """Model call, token and wall-clock limits of one analysis
+
+    usage is kept in the analysis checkpoint, so a resumed run continues
+    from what earlier runs spent and keeps the original deadline.
+    """
+
+    def __init__(self, max_model_calls=None, max_tokens=None, deadline_seconds=None, usage=None):
+        self.max_model_calls = max_model_calls
+        self.max_tokens = max_tokens
+        self.deadline_seconds = deadline_seconds
+        self.usage = usage if usage is not None else {
+            'model_calls': 0,
+            'estimated_tokens': 0,
+            'started_at': time.time()
+        }
+
+    @classmethod
+    def from_parameters(cls, parameters, usage=None):
+        """Build the budget an analysis asks for, or None if it sets no limits"""
+        limits = {
+            'max_model_calls': parameters.get('max_model_calls'),
+            'max_tokens': parameters.get('max_tokens'),
+            'deadline_seconds': parameters.get('deadline_seconds')
+        }
+        if all(value is None for value in limits.values()):
+            return None
+        return cls(
+            max_model_calls=int(limits['max_model_calls']) if limits['max_model_calls'] is not None else None,
+            max_tokens=int(limits['max_tokens']) if limits['max_tokens'] is not None else None,
+            deadline_seconds=float(limits['deadline_seconds']) if limits['deadline_seconds'] is not None else None,
+            usage=usage
+        )
+
+    def deadline_passed(self):
+        return self.deadline_seconds is not None and time.time() - self.usage['started_at'] >= self.deadline_seconds
+
+    def charge(self, calls, tokens):
+        """Account for a model call before it is made, or raise BudgetExhausted"""
+        if self.deadline_passed():
+            raise BudgetExhausted('deadline')
+        if self.max_model_calls is not None and self.usage['model_calls'] + calls > self.max_model_calls:
+            raise BudgetExhausted('call_budget')
+        if self.max_tokens is not None and self.usage['estimated_tokens'] + tokens > self.max_tokens:
+            raise BudgetExhausted('token_budget')
+        self.usage['model_calls'] += calls
+        self.usage['estimated_tokens'] += tokens
+
+
+class MeteredGeminiService:
+    """GeminiService that charges every call against an AnalysisBudget first"""
+
+    def __init__(self, gemini_service, budget):
+        self.gemini_service = gemini_service
+        self.budget = budget
+
+    def identify_objects(self, image_url):
+        self.budget.charge(1, ESTIMATED_TOKENS_PER_IMAGE + ESTIMATED_TOKENS_PER_CALL)
+        return self.gemini_service.identify_objects(image_url)
+
+    def compare_scenes(self, image_url1, image_url2):
+        self.budget.charge(1, 2 * ESTIMATED_TOKENS_PER_IMAGE + ESTIMATED_TOKENS_PER_CALL)
+        return self.gemini_service.compare_scenes(image_url1, image_url2)
@@ -0,0 +1,105 @@
+"""Pluggable persistence backends
+
+PERSISTENCE_BACKEND selects where documents and media files live:
+
+- firebase (default): Firestore and Cloud Storage
+- local: SQLite at LOCAL_DATABASE_PATH and files under LOCAL_BLOB_ROOT,
+  served from LOCAL_MEDIA_URL. Changes are queued for a later sync to
+  Firebase with `python -m services.local_store sync`.
+
+Services get their clients from get_database() and get_bucket() and use
+the Firestore client API either way; transactional functions are
+decorated with transactional() instead of firestore.transactional. The
+database client counts its round trips against the current request.
+"""
+import os
+import functools
+import threading
+import firebase_admin
+from firebase_admin import credentials, firestore, storage
+
+from services.document_loader import CountedClient, count_round_trips
+from services.local_store import (
+    LocalDatabase, LocalBucket, LocalTransaction,
+    DEFAULT_DATABASE_PATH, DEFAULT_BLOB_ROOT, DEFAULT_MEDIA_URL
+)
+
+_local_lock = threading.Lock()
+_local_database = None
+_local_bucket = None
+
+
+def backend():
+    """Name of the configured backend"""
+    return os.getenv('PERSISTENCE_BACKEND', 'firebase').lower()
+
+
+def is_local():
+    return backend() == 'local'
+
+
+def init_firebase():
+    """Initialize the Firebase Admin SDK once per process"""
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        # Use application default credentials or service account
+        if os.path.exists('firebase-credentials.json'):
+            cred = credentials.Certificate('firebase-credentials.json')
+            firebase_admin.initialize_app(cred)
+        else:
+            firebase_admin.initialize_app()
+
+
+def local_database():
+    """The process-wide local database"""
+    global _local_database
+    with _local_lock:
+        if _local_database is None:
+            _local_database = LocalDatabase(os.getenv('LOCAL_DATABASE_PATH', DEFAULT_DATABASE_PATH))
+        return _local_database
+
+
+def local_bucket():
+    """The process-wide local blob store"""
+    global _local_bucket
+    database = local_database()
+    with _local_lock:
+        if _local_bucket is None:
+            _local_bucket = LocalBucket(
+                os.getenv('LOCAL_BLOB_ROOT', DEFAULT_BLOB_ROOT),
+                os.getenv('LOCAL_MEDIA_URL', DEFAULT_MEDIA_URL),
+                database=database
+            )
+        return _local_bucket
+
+
+def get_database():
+    """Document database client for the configured backend"""
+    if is_local():
+        return CountedClient(local_database())
+    init_firebase()
+    return CountedClient(firestore.client())
+
+
+def get_bucket():
+    """Blob storage bucket for the configured backend"""
+    if is_local():
+        return local_bucket()
+    init_firebase()
+    return storage.bucket()
+
+
+def transactional(function):
+    """Like firestore.transactional, for transactions from either backend"""
+    remote = firestore.transactional(function)
+
+    @functools.wraps(function)
+    def run(transaction, *args, **kwargs):
+        # Begin and commit; reads inside count on their own
+        count_round_trips(2)
+        if isinstance(transaction, LocalTransaction):
+            return transaction.db.run_transaction(function, transaction, *args, **kwargs)
+        return remote(transaction, *args, **kwargs)
+
+    return run
@@ -0,0 +1,123 @@
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import ffmpeg
+
+from services.persistence import get_database, get_bucket
+
+PROXY_HEIGHT = 540
+PROXY_VIDEO_BITRATE = '1200k'
+PROXY_AUDIO_BITRATE = '96k'
+# A keyframe every two seconds keeps seeking in the review player cheap
+PROXY_GOP = 48
+STRIP_FRAMES = 10
+STRIP_FRAME_WIDTH = 160
+
+
+class ProxyService:
+    def __init__(self, max_workers=1):
+        self.db = get_database()
+        self.bucket = get_bucket()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='proxy')
+
+    def enqueue_asset(self, asset, callback=None):
+        """Generate proxies for a video asset in the background
+
+        callback, if given, receives the updated asset once proxies exist.
+        """
+        if not asset or asset.get('type') != 'video':
+            return None
+        return self.executor.submit(self._generate_and_notify, asset, callback)
+
+    def _generate_and_notify(self, asset, callback):
+        updated = self.generate_proxies(asset) or asset
+        if callback:
+            callback(updated)
+        return updated
+
+    def generate_proxies(self, asset):
+        """Transcode a low-bitrate proxy, a poster frame and a thumbnail strip"""
+        try:
+            source = asset['url']
+            duration = self._probe_duration(source)
+
+            with tempfile.TemporaryDirectory() as workdir:
+                proxy_file = os.path.join(workdir, 'proxy.mp4')
+                poster_file = os.path.join(workdir, 'poster.jpg')
+                strip_file = os.path.join(workdir, 'strip.jpg')
+
+                (
+                    ffmpeg
+                    .input(source)
+                    .output(
+                        proxy_file,
+                        vf=f"scale=-2:{PROXY_HEIGHT}",
+                        vcodec='libx264', preset='veryfast',
+                        video_bitrate=PROXY_VIDEO_BITRATE,
+                        maxrate=PROXY_VIDEO_BITRATE, bufsize='2400k',
+                        g=PROXY_GOP, pix_fmt='yuv420p',
+                        acodec='aac', audio_bitrate=PROXY_AUDIO_BITRATE,
+                        # Index at the front so players can seek before the download ends
+                        movflags='+faststart'
+                    )
+                    .overwrite_output()
+                    .run(quiet=True)
+                )
+
+                # Poster and strip are cut from the proxy, not the camera original
+                (
+                    ffmpeg
+                    .input(proxy_file, ss=duration / 2 if duration else 0)
+                    .output(poster_file, vframes=1, vf=f"scale={STRIP_FRAME_WIDTH * 2}:-2")
+                    .overwrite_output()
+                    .run(quiet=True)
+                )
+
+                interval = duration / STRIP_FRAMES if duration else 1
+                (
+                    ffmpeg
+                    .input(proxy_file)
+                    .output(
+                        strip_file, vframes=1,
+                        vf=f"fps=1/{interval:.3f},scale={STRIP_FRAME_WIDTH}:-2,tile={STRIP_FRAMES}x1"
+                    )
+                    .overwrite_output()
+                    .run(quiet=True)
+                )
+
+                base_path = f"projects/{asset['project_id']}"
+                proxy = self._upload(proxy_file, f"{base_path}/proxies/{asset['asset_id']}.mp4", 'video/mp4')
+                poster = self._upload(poster_file, f"{base_path}/thumbnails/{asset['asset_id']}.jpg", 'image/jpeg')
+                strip = self._upload(strip_file, f"{base_path}/thumbnails/{asset['asset_id']}_strip.jpg", 'image/jpeg')
+
+            updates = {
+                'proxy': dict(proxy, height=PROXY_HEIGHT, video_bitrate=PROXY_VIDEO_BITRATE),
+                'thumbnail_url': poster['url'],
+                'thumbnail_strip': dict(strip, frames=STRIP_FRAMES, interval_seconds=round(interval, 3)),
+                'duration_seconds': duration
+            }
+            self.db.collection('assets').document(asset['asset_id']).update(updates)
+
+            return dict(asset, **updates)
+        except ffmpeg.Error as e:
+            stderr = e.stderr.decode(errors='replace') if e.stderr else str(e)
+            print(f"Error generating proxies for {asset.get('asset_id')}: {stderr}")
+            return None
+        except Exception as e:
+            print(f"Error generating proxies for {asset.get('asset_id')}: {str(e)}")
+            return None
+
+    def _probe_duration(self, source):
+        try:
+            return float(ffmpeg.probe(source)['format']['duration'])
+        except (ffmpeg.Error, KeyError, ValueError):
+            return None
+
+    def _upload(self, path, storage_path, content_type):
+        blob = self.bucket.blob(storage_path)
+        blob.upload_from_filename(path, content_type=content_type)
+        return {
+            'storage_path': storage_path,
+            'url': blob.public_url,
+            'size': os.path.getsize(path)
+        }
@@ -0,0 +1,309 @@
+import uuid
+from itertools import islice
+import numpy as np
+
+from services.continuity_checks import get_scene_number, get_indexed_objects, media_url, meets_severity_threshold, is_asset
+
+DEFAULT_BLOCK_SIZE = 4096
+
+
+def make_issue(asset1, asset2, issue_type, severity, description, confidence, resolution, frames=None):
+    """Build a continuity issue dict for an asset pair"""
+    return {
+        'issue_id': str(uuid.uuid4()),
+        'type': issue_type,
+        'severity': severity,
+        'description': description,
+        'affected_assets': [asset1.get('asset_id'), asset2.get('asset_id')],
+        'affected_scenes': [get_scene_number(asset1), get_scene_number(asset2)],
+        'frames': frames if frames is not None else [],
+        'confidence_score': confidence,
+        'suggested_resolution': resolution
+    }
+
+
+def excess_confidence(values, threshold):
+    """Map how far values exceed a threshold onto a 0.5-1.0 confidence"""
+    excess = (values - threshold) / max(threshold, 1e-9)
+    return np.round(0.5 + 0.5 * np.clip(excess, 0.0, 1.0), 3)
+
+
+class ContinuityRule:
+    """Base class for rule types
+
+    Local rules declare the indexed features they need and are evaluated for
+    a whole block of pairs at once from per-asset feature matrices. Remote
+    rules are evaluated one pair at a time and may call the Gemini API.
+    """
+    rule_type = None
+    required_features = []
+    local = True
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.parameters = rule.get('parameters', {}) or {}
+        # Issues less severe than this are not reported
+        self.severity_threshold = rule.get('severity_threshold') or self.parameters.get('severity_threshold')
+
+    def reports(self, issue):
+        """Whether an issue meets the rule's severity threshold"""
+        return meets_severity_threshold(issue['severity'], self.severity_threshold)
+
+    def encode(self, features):
+        """Turn an asset's indexed features into a fixed-width row, or None"""
+        raise NotImplementedError
+
+    def feature_matrix(self, assets):
+        """Stack encoded features of all assets; rows without features are NaN"""
+        rows = None
+        for index, asset in enumerate(assets):
+            features = asset.get('features', {}) if is_asset(asset) else {}
+            if any(name not in features or features[name] is None for name in self.required_features):
+                continue
+            row = self.encode(features)
+            if row is None:
+                continue
+            if rows is None:
+                rows = np.full((len(assets), len(row)), np.nan)
+            rows[index] = row
+        return rows
+
+    def evaluate_block(self, matrix, left, right):
+        """Return (flagged mask, confidence) arrays for pairs left[k], right[k]"""
+        raise NotImplementedError
+
+    def describe(self, asset1, asset2, matrix, i, j, confidence):
+        """Build the issue for one flagged pair"""
+        raise NotImplementedError
+
+    def evaluate_pair(self, gemini_service, asset1, asset2):
+        """Return the issues for one pair (remote rules only)"""
+        raise NotImplementedError
+
+
+class LightingRule(ContinuityRule):
+    rule_type = 'lighting'
+    required_features = ['lighting']
+
+    def encode(self, features):
+        lighting = features['lighting']
+        return [lighting['direction'][0], lighting['direction'][1], lighting['strength'], lighting['intensity']]
+
+    def evaluate_block(self, matrix, left, right):
+        a = matrix[left]
+        b = matrix[right]
+        max_angle = float(self.parameters.get('max_angle_degrees', 45))
+        max_intensity_delta = float(self.parameters.get('max_intensity_delta', 40))
+        min_strength = float(self.parameters.get('min_gradient_strength', 0.01))
+
+        # Only compare direction when both frames have a clear key light
+        directional = (a[:, 2] >= min_strength) & (b[:, 2] >= min_strength)
+        cosine = np.clip(np.einsum('ij,ij->i', a[:, :2], b[:, :2]), -1.0, 1.0)
+        angle = np.degrees(np.arccos(cosine))
+        intensity_delta = np.abs(a[:, 3] - b[:, 3])
+
+        direction_shift = directional & (angle > max_angle)
+        intensity_shift = intensity_delta > max_intensity_delta
+        confidence = np.maximum(
+            np.where(direction_shift, excess_confidence(angle, max_angle), 0.0),
+            np.where(intensity_shift, excess_confidence(intensity_delta, max_intensity_delta), 0.0)
+        )
+        return direction_shift | intensity_shift, confidence
+
+    def describe(self, asset1, asset2, matrix, i, j, confidence):
+        scene1 = get_scene_number(asset1)
+        scene2 = get_scene_number(asset2)
+        return make_issue(
+            asset1, asset2, 'lighting_shift', 'warning',
+            f"Lighting direction or intensity changes between scene {scene1} and {scene2}",
+            confidence,
+            "Match key light position and exposure between the shots"
+        )
+
+
+class TimeOfDayRule(ContinuityRule):
+    rule_type = 'time_of_day'
+    required_features = ['color_temperature']
+
+    def encode(self, features):
+        return [features['color_temperature']['mired']]
+
+    def evaluate_block(self, matrix, left, right):
+        # Mireds are closer to perceptual distance than kelvin
+        max_mired_delta = float(self.parameters.get('max_mired_delta', 60))
+        delta = np.abs(matrix[left, 0] - matrix[right, 0])
+        return delta > max_mired_delta, excess_confidence(delta, max_mired_delta)
+
+    def describe(self, asset1, asset2, matrix, i, j, confidence):
+        kelvin1 = round(1e6 / matrix[i, 0])
+        kelvin2 = round(1e6 / matrix[j, 0])
+        return make_issue(
+            asset1, asset2, 'time_of_day_mismatch', 'warning',
+            f"Color temperature shifts from {kelvin1}K in scene {get_scene_number(asset1)} "
+            f"to {kelvin2}K in scene {get_scene_number(asset2)}",
+            confidence,
+            "Check that both shots are meant to play at the same time of day"
+        )
+
+
+class ClothingRule(ContinuityRule):
+    rule_type = 'clothing'
+    required_features = ['clothing_colors']
+
+    def encode(self, features):
+        colors = features['clothing_colors']
+        if not colors:
+            return None
+        return colors[0]['rgb']
+
+    def evaluate_block(self, matrix, left, right):
+        max_color_distance = float(self.parameters.get('max_color_distance', 80))
+        distance = np.linalg.norm(matrix[left] - matrix[right], axis=1)
+        return distance > max_color_distance, excess_confidence(distance, max_color_distance)
+
+    def describe(self, asset1, asset2, matrix, i, j, confidence):
+        return make_issue(
+            asset1, asset2, 'clothing_mismatch', 'warning',
+            f"Dominant costume color differs between scene {get_scene_number(asset1)} "
+            f"and {get_scene_number(asset2)}",
+            confidence,
+            "Verify wardrobe against the continuity photos"
+        )
+
+
+class ObjectTrackingRule(ContinuityRule):
+    rule_type = 'object_tracking'
+    local = False
+
+    def evaluate_pair(self, gemini_service, asset1, asset2):
+        # Prefer objects indexed at upload time; fall back to Gemini
+        objects1 = get_indexed_objects(asset1)
+        if objects1 is None:
+            objects1 = gemini_service.identify_objects(media_url(asset1))
+        objects2 = get_indexed_objects(asset2)
+        if objects2 is None:
+            objects2 = gemini_service.identify_objects(media_url(asset2))
+
+        # Compare objects for inconsistencies
+        # For demo, we'll just create a simulated issue
+        return [make_issue(
+            asset1, asset2, 'object_mismatch', 'warning',
+            f"Possible object inconsistency between scene {get_scene_number(asset1)} and {get_scene_number(asset2)}",
+            0.85,
+            "Verify that the prop appears consistently",
+            frames=[100, 200]  # Placeholder frame numbers
+        )]
+
+
+class PropsRule(ContinuityRule):
+    rule_type = 'props'
+    local = False
+
+    def evaluate_pair(self, gemini_service, asset1, asset2):
+        comparison = gemini_service.compare_scenes(media_url(asset1), media_url(asset2))
+        issues = []
+        for found in comparison.get('issues', []):
+            if found.get('type') != 'prop_inconsistency':
+                continue
+            issues.append(make_issue(
+                asset1, asset2, 'prop_inconsistency', 'warning',
+                found.get('description', ''),
+                found.get('confidence', 0.5),
+                "Check prop placement and appearance against the reference shot"
+            ))
+        return issues
+
+
+RULE_TYPES = {
+    rule_class.rule_type: rule_class
+    for rule_class in [LightingRule, TimeOfDayRule, ClothingRule, ObjectTrackingRule, PropsRule]
+}
+
+
+class RuleEngine:
+    def __init__(self, rules):
+        self.rules = [RULE_TYPES[rule.get('rule_type')](rule) for rule in rules if rule.get('rule_type') in RULE_TYPES]
+        self._prepared_assets = None
+        self._matrices = {}
+
+    def required_features(self):
+        """Indexed features the configured local rules depend on"""
+        return sorted({name for rule in self.rules if rule.local for name in rule.required_features})
+
+    def prepare(self, assets):
+        """Build per-asset feature matrices for the local rules"""
+        self._matrices = {index: rule.feature_matrix(assets) for index, rule in enumerate(self.rules) if rule.local}
+        self._prepared_assets = assets
+
+    def _local_issues(self, assets, pairs):
+        """Evaluate the local rules for a block of pairs at once
+
+        Returns {rule index: {pair position: issue}}.
+        """
+        if self._prepared_assets is not assets:
+            self.prepare(assets)
+
+        found = {}
+        if not pairs:
+            return found
+
+        pair_array = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        left = pair_array[:, 0]
+        right = pair_array[:, 1]
+
+        for rule_index, matrix in self._matrices.items():
+            if matrix is None:
+                continue
+            rule = self.rules[rule_index]
+            # Pairs missing features on either side have NaN rows; skip them
+            known = ~(np.isnan(matrix[left]).any(axis=1) | np.isnan(matrix[right]).any(axis=1))
+            with np.errstate(invalid='ignore'):
+                flagged, confidence = rule.evaluate_block(matrix, left, right)
+            rule_issues = {}
+            for k in np.flatnonzero(flagged & known):
+                i, j = int(left[k]), int(right[k])
+                issue = rule.describe(assets[i], assets[j], matrix, i, j, float(confidence[k]))
+                if rule.reports(issue):
+                    rule_issues[int(k)] = issue
+            found[rule_index] = rule_issues
+
+        return found
+
+    def _pair_issues(self, gemini_service, assets, pair, position, local_issues):
+        """Collect the issues of one pair in rule order, calling remote rules"""
+        i, j = pair
+        issues = []
+        for rule_index, rule in enumerate(self.rules):
+            if rule.local:
+                issue = local_issues.get(rule_index, {}).get(position)
+                if issue:
+                    issues.append(issue)
+            else:
+                issues.extend(issue for issue in rule.evaluate_pair(gemini_service, assets[i], assets[j]) if rule.reports(issue))
+        return issues
+
+    def evaluate(self, gemini_service, assets, pairs):
+        """Evaluate all rules for a block of (i, j) pairs
+
+        Returns one issue list per pair, in pair order, with issues of each
+        pair in rule order.
+        """
+        local_issues = self._local_issues(assets, pairs)
+        return [
+            self._pair_issues(gemini_service, assets, pair, position, local_issues)
+            for position, pair in enumerate(pairs)
+        ]
+
+    def iter_results(self, gemini_service, assets, pairs, block_size=DEFAULT_BLOCK_SIZE):
+        """Evaluate an iterable of pairs block by block, yielding (pair, issues)
+
+        Local rules run once per block; remote rules run lazily as each pair
+        is yielded, so a caller that stops early makes no further model calls.
+        """
+        pairs = iter(pairs)
+        block = list(islice(pairs, block_size))
+        while block:
+            local_issues = self._local_issues(assets, block)
+            for position, pair in enumerate(block):
+                yield pair, self._pair_issues(gemini_service, assets, pair, position, local_issues)
+            block = list(islice(pairs, block_size))
@@ -0,0 +1,235 @@
+import time
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+MAX_PROJECTS = 64
+IDLE_SECONDS = 30 * 60
+# Rebuild periodically to pick up writes made by other server processes
+MAX_AGE_SECONDS = 10 * 60
+
+INDEXED_FIELDS = ['tag', 'scene', 'shot', 'content_type', 'type']
+
+
+def asset_terms(asset):
+    """Yield (field, value) terms an asset is indexed under"""
+    metadata = asset.get('metadata') or {}
+    scene_info = asset.get('scene_info') or metadata.get('scene_info') or {}
+
+    for tag in metadata.get('tags') or []:
+        yield 'tag', str(tag).lower()
+    if scene_info.get('scene_number') is not None:
+        yield 'scene', str(scene_info['scene_number'])
+    if scene_info.get('shot_number') is not None:
+        yield 'shot', str(scene_info['shot_number'])
+    if asset.get('content_type'):
+        yield 'content_type', asset['content_type']
+    if asset.get('type'):
+        yield 'type', asset['type']
+
+
+def utc_timestamp(value):
+    """POSIX timestamp of a datetime, treating naive values as UTC"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def upload_time(asset):
+    """Upload time as a timestamp; assets just written carry a sentinel"""
+    uploaded_at = asset.get('uploaded_at')
+    if isinstance(uploaded_at, datetime):
+        return utc_timestamp(uploaded_at)
+    return time.time()
+
+
+class ProjectAssetIndex:
+    """Inverted index over the assets of one project"""
+
+    def __init__(self, assets):
+        self.assets = {}
+        self.postings = {field: {} for field in INDEXED_FIELDS}
+        self.by_time = []
+        self.built_at = time.monotonic()
+        for asset in assets:
+            self.add(asset)
+
+    def add(self, asset):
+        asset_id = asset.get('asset_id')
+        if not asset_id:
+            return
+        if asset_id in self.assets:
+            self.remove(asset_id)
+
+        self.assets[asset_id] = (asset, upload_time(asset))
+        for field, value in asset_terms(asset):
+            self.postings[field].setdefault(value, set()).add(asset_id)
+        insort(self.by_time, (self.assets[asset_id][1], asset_id))
+
+    def remove(self, asset_id):
+        entry = self.assets.pop(asset_id, None)
+        if not entry:
+            return
+        asset, uploaded = entry
+        for field, value in asset_terms(asset):
+            ids = self.postings[field].get(value)
+            if ids is not None:
+                ids.discard(asset_id)
+                if not ids:
+                    del self.postings[field][value]
+
+        position = bisect_left(self.by_time, (uploaded, asset_id))
+        if position < len(self.by_time) and self.by_time[position] == (uploaded, asset_id):
+            del self.by_time[position]
+
+    def apply(self, action, value):
+        """Apply a recorded change: ('add', asset) or ('remove', asset_id)"""
+        if action == 'add':
+            self.add(value)
+        else:
+            self.remove(value)
+
+    def search(self, terms, uploaded_after=None, uploaded_before=None):
+        """Return assets matching every (field, value) term and the time range, oldest first"""
+        candidate_sets = []
+        for field, value in terms:
+            candidate_sets.append(self.postings[field].get(value, set()))
+
+        if uploaded_after is not None or uploaded_before is not None:
+            low = bisect_left(self.by_time, (uploaded_after,)) if uploaded_after is not None else 0
+            high = bisect_right(self.by_time, (uploaded_before, chr(0x10FFFF))) if uploaded_before is not None else len(self.by_time)
+            candidate_sets.append({asset_id for _, asset_id in self.by_time[low:high]})
+
+        if candidate_sets:
+            # Intersect starting from the most selective term
+            candidate_sets.sort(key=len)
+            matches = set(candidate_sets[0])
+            for ids in candidate_sets[1:]:
+                if not matches:
+                    break
+                matches &= ids
+            ordered = sorted(matches, key=lambda asset_id: self.assets[asset_id][1])
+        else:
+            ordered = [asset_id for _, asset_id in self.by_time]
+
+        return [self.assets[asset_id][0] for asset_id in ordered]
+
+
+class AssetSearchIndex:
+    """Per-project asset indexes kept in memory for recently used projects
+
+    A project is indexed on its first search and kept up to date by upload
+    and delete; changes made while the index is being built are replayed
+    onto it. Projects not searched for IDLE_SECONDS, or beyond the
+    MAX_PROJECTS most recently used, are evicted.
+    """
+
+    def __init__(self, max_projects=MAX_PROJECTS, idle_seconds=IDLE_SECONDS, max_age_seconds=MAX_AGE_SECONDS):
+        self.max_projects = max_projects
+        self.idle_seconds = idle_seconds
+        self.max_age_seconds = max_age_seconds
+        self.projects = OrderedDict()
+        self.last_used = {}
+        # Changes seen while a project is being built, one log per build
+        self.building = {}
+        self.lock = threading.Lock()
+
+    def search(self, project_id, load_assets, tags=None, scene=None, shot=None, content_type=None,
+               asset_type=None, uploaded_after=None, uploaded_before=None):
+        """Search a project's assets, building its index with load_assets() if cold"""
+        terms = [('tag', str(tag).lower()) for tag in tags or []]
+        if scene is not None:
+            terms.append(('scene', str(scene)))
+        if shot is not None:
+            terms.append(('shot', str(shot)))
+        if content_type:
+            terms.append(('content_type', content_type))
+        if asset_type:
+            terms.append(('type', asset_type))
+
+        with self.lock:
+            index = self._get(project_id)
+            if index is None:
+                changes = []
+                self.building.setdefault(project_id, []).append(changes)
+
+        if index is None:
+            # Build outside the lock so a cold project does not block others
+            try:
+                built = ProjectAssetIndex(load_assets(project_id))
+            except Exception:
+                with self.lock:
+                    self._finish_build(project_id, changes)
+                raise
+            with self.lock:
+                self._finish_build(project_id, changes)
+                # Uploads and deletes during the load may be missing from it
+                for action, value in changes:
+                    built.apply(action, value)
+                # A concurrent build may have finished first; it is kept current too
+                index = self.projects.get(project_id)
+                if index is None:
+                    index = built
+                    self._put(project_id, index)
+
+        with self.lock:
+            return index.search(
+                terms,
+                utc_timestamp(uploaded_after) if uploaded_after else None,
+                utc_timestamp(uploaded_before) if uploaded_before else None
+            )
+
+    def add_asset(self, asset):
+        """Index a newly uploaded asset if its project is loaded or loading"""
+        if not isinstance(asset.get('uploaded_at'), datetime):
+            # Results are served as JSON, so the write's timestamp sentinel
+            # is replaced the way DocumentLoader.prime does
+            asset = dict(asset, uploaded_at=datetime.now(timezone.utc))
+        self._record(asset.get('project_id'), 'add', asset)
+
+    def remove_asset(self, project_id, asset_id):
+        """Drop a deleted asset if its project is loaded or loading"""
+        self._record(project_id, 'remove', asset_id)
+
+    def _record(self, project_id, action, value):
+        with self.lock:
+            index = self.projects.get(project_id)
+            if index is not None:
+                index.apply(action, value)
+            for changes in self.building.get(project_id, []):
+                changes.append((action, value))
+
+    def _finish_build(self, project_id, changes):
+        logs = [log for log in self.building.get(project_id, []) if log is not changes]
+        if logs:
+            self.building[project_id] = logs
+        else:
+            self.building.pop(project_id, None)
+
+    def _get(self, project_id):
+        self._evict()
+        index = self.projects.get(project_id)
+        if index is None:
+            return None
+        if time.monotonic() - index.built_at > self.max_age_seconds:
+            del self.projects[project_id]
+            del self.last_used[project_id]
+            return None
+        self.projects.move_to_end(project_id)
+        self.last_used[project_id] = time.monotonic()
+        return index
+
+    def _put(self, project_id, index):
+        self.projects[project_id] = index
+        self.last_used[project_id] = time.monotonic()
+        self._evict()
+
+    def _evict(self):
+        now = time.monotonic()
+        for project_id in [p for p, used in self.last_used.items() if now - used > self.idle_seconds]:
+            del self.projects[project_id]
+            del self.last_used[project_id]
+        while len(self.projects) > self.max_projects:
+            project_id, _ = self.projects.popitem(last=False)
+            del self.last_used[project_id]
@@ -0,0 +1,349 @@
+import os
+import sys
+import json
+import heapq
+import time
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from services.gemini_service import GeminiService
+from services.continuity_checks import get_scene_number, build_summary, merge_summaries
+from services.rule_engine import RuleEngine
+
+DEFAULT_MAX_PAIRS_PER_SHARD = 256
+# A claimed shard without a result after this long is handed to another worker
+DEFAULT_CLAIM_TIMEOUT_SECONDS = 1800
+
+
+def bucket_by_scene(assets):
+    """Group asset indices by scene number, in first-seen order"""
+    buckets = {}
+    for index, asset in enumerate(assets):
+        scene = get_scene_number(asset)
+        if scene:
+            buckets.setdefault(scene, []).append(index)
+    return buckets
+
+
+def plan_shards(assets, max_pairs_per_shard=DEFAULT_MAX_PAIRS_PER_SHARD, pairs=None):
+    """Partition the cross-scene pair space into shard descriptors
+
+    Every shard covers one pair of scene buckets. Large bucket pairs are split
+    into blocks of rows and, for buckets larger than a shard, columns, so no
+    shard holds more than max_pairs_per_shard pairs.
+    When an explicit list of pairs is given (e.g. from the similarity index)
+    only those are planned, and each shard lists its pairs. Descriptors are
+    plain dicts and can be serialized as JSON.
+    """
+    buckets = list(bucket_by_scene(assets).items())
+    max_pairs_per_shard = max(1, int(max_pairs_per_shard))
+    shards = []
+
+    if pairs is not None:
+        bucket_of = {}
+        for position, (_, members) in enumerate(buckets):
+            for index in members:
+                bucket_of[index] = position
+
+        grouped = {}
+        for i, j in pairs:
+            a, b = sorted((bucket_of[i], bucket_of[j]))
+            grouped.setdefault((a, b), []).append([i, j])
+
+        for a, b in sorted(grouped):
+            bucket_pairs = grouped[(a, b)]
+            for chunk, start in enumerate(range(0, len(bucket_pairs), max_pairs_per_shard)):
+                shards.append({
+                    'shard_id': f"{a}-{b}-{chunk}",
+                    'seq': len(shards),
+                    'scenes': [buckets[a][0], buckets[b][0]],
+                    'pairs': bucket_pairs[start:start + max_pairs_per_shard]
+                })
+        return shards
+
+    for a, (scene1, left) in enumerate(buckets):
+        for b in range(a + 1, len(buckets)):
+            scene2, right = buckets[b]
+            columns_per_chunk = min(len(right), max_pairs_per_shard)
+            rows_per_chunk = max(1, max_pairs_per_shard // columns_per_chunk)
+            chunk = 0
+            for row in range(0, len(left), rows_per_chunk):
+                for column in range(0, len(right), columns_per_chunk):
+                    shards.append({
+                        'shard_id': f"{a}-{b}-{chunk}",
+                        'seq': len(shards),
+                        'scenes': [scene1, scene2],
+                        'left': left[row:row + rows_per_chunk],
+                        'right': right[column:column + columns_per_chunk]
+                    })
+                    chunk += 1
+
+    return shards
+
+
+def shard_pairs(shard):
+    """Return the (i, j) pairs covered by a shard, sorted ascending"""
+    if 'pairs' in shard:
+        return sorted((min(i, j), max(i, j)) for i, j in shard['pairs'])
+    return sorted((min(i, j), max(i, j)) for i in shard['left'] for j in shard['right'])
+
+
+def prepared_engine(assets, rules):
+    """Build a rule engine with its feature matrices over all assets"""
+    engine = RuleEngine(rules)
+    engine.prepare(assets)
+    return engine
+
+
+def execute_shard(shard, assets, rules, gemini_service, engine=None):
+    """Run the continuity checks for every pair in a shard
+
+    Pass an engine prepared for the same assets and rules to reuse its
+    feature matrices across shards.
+    """
+    pair_results = []
+    shard_issues = []
+    pairs = shard_pairs(shard)
+    engine = engine or prepared_engine(assets, rules)
+    for (i, j), issues in engine.iter_results(gemini_service, assets, pairs):
+        if issues:
+            pair_results.append([[i, j], issues])
+            shard_issues.extend(issues)
+
+    return {
+        'shard_id': shard['shard_id'],
+        'seq': shard['seq'],
+        'pair_count': len(pairs),
+        'pairs': pair_results,
+        'summary': build_summary(shard_issues)
+    }
+
+
+def merge_shard_results(results):
+    """Merge shard results into one issue list and summary
+
+    Issues are ordered by asset pair, so the merged output is the same no
+    matter which worker finished first, and matches a sequential run.
+    """
+    results = sorted(results, key=lambda result: result['seq'])
+    streams = [result['pairs'] for result in results]
+
+    continuity_issues = []
+    for _, issues in heapq.merge(*streams, key=lambda item: tuple(item[0])):
+        continuity_issues.extend(issues)
+
+    summary = merge_summaries(result['summary'] for result in results)
+    return continuity_issues, summary
+
+
+# Per-process state for pool workers, set once by the initializer so assets
+# and rules are not pickled again for every shard
+_worker_state = {}
+
+
+def _init_worker(assets, rules):
+    _worker_state['assets'] = assets
+    _worker_state['rules'] = rules
+    _worker_state['gemini_service'] = GeminiService()
+    _worker_state['engine'] = prepared_engine(assets, rules)
+
+
+def _run_shard(shard):
+    return execute_shard(
+        shard, _worker_state['assets'], _worker_state['rules'],
+        _worker_state['gemini_service'], _worker_state['engine']
+    )
+
+
+class ShardedAnalysisExecutor:
+    def __init__(self, max_workers=None, max_pairs_per_shard=DEFAULT_MAX_PAIRS_PER_SHARD):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pairs_per_shard = max_pairs_per_shard
+
+    def run(self, assets, rules, pairs=None):
+        """Compare cross-scene pairs on a process pool, all of them unless given"""
+        shards = plan_shards(assets, self.max_pairs_per_shard, pairs)
+        if not shards:
+            return [], build_summary([])
+        return merge_shard_results(list(self.iter_results(assets, rules, shards)))
+
+    def iter_results(self, assets, rules, shards):
+        """Run shards on a process pool, yielding their results in shard order"""
+        if not shards:
+            return
+
+        # chunksize=1 keeps shards on the pool's shared call queue, so a worker
+        # that finishes early picks up the next shard instead of idling
+        # Workers are spawned, not forked: the server process has gRPC
+        # channels and thread pools running, which a fork cannot copy safely.
+        # _init_worker sets up everything a worker needs.
+        pool = ProcessPoolExecutor(
+            max_workers=min(self.max_workers, len(shards)),
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(assets, rules)
+        )
+        try:
+            for result in pool.map(_run_shard, shards, chunksize=1):
+                yield result
+        finally:
+            # Drop queued shards if the caller stops early
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+class ShardQueue:
+    """Directory-backed shard queue that several worker machines can share
+
+    Each job lives in <root>/<job_id>/: job.json holds the assets and rules,
+    and pending/, claimed/ and done/ hold one JSON file per shard. A shard is
+    claimed with an atomic rename, so exactly one worker processes it. A claim
+    that has no result after claim_timeout seconds, e.g. because its worker
+    died, is moved back to pending/ for the next worker.
+    """
+
+    def __init__(self, root, claim_timeout=DEFAULT_CLAIM_TIMEOUT_SECONDS):
+        self.root = root
+        self.claim_timeout = claim_timeout
+        os.makedirs(self.root, exist_ok=True)
+
+    def _job_dir(self, job_id, *parts):
+        return os.path.join(self.root, job_id, *parts)
+
+    def _write_json(self, path, data):
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, default=str)
+        os.replace(tmp_path, path)
+
+    def _read_json(self, path):
+        with open(path) as f:
+            return json.load(f)
+
+    def publish(self, assets, rules, max_pairs_per_shard=DEFAULT_MAX_PAIRS_PER_SHARD, job_id=None, pairs=None):
+        """Plan shards for a job and enqueue them"""
+        job_id = job_id or str(uuid.uuid4())
+        for state in ['pending', 'claimed', 'done']:
+            os.makedirs(self._job_dir(job_id, state), exist_ok=True)
+
+        shards = plan_shards(assets, max_pairs_per_shard, pairs)
+        self._write_json(self._job_dir(job_id, 'job.json'), {
+            'job_id': job_id,
+            'shard_count': len(shards),
+            'assets': assets,
+            'rules': rules
+        })
+        for shard in shards:
+            self._write_json(self._job_dir(job_id, 'pending', f"{shard['seq']:08d}.json"), shard)
+
+        return job_id
+
+    def requeue_stale_claims(self, job_id):
+        """Move claims older than claim_timeout back to pending, returning how many"""
+        claimed_dir = self._job_dir(job_id, 'claimed')
+        try:
+            names = os.listdir(claimed_dir)
+        except FileNotFoundError:
+            return 0
+
+        requeued = 0
+        cutoff = time.time() - self.claim_timeout
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            claimed_path = os.path.join(claimed_dir, name)
+            try:
+                if os.path.getmtime(claimed_path) >= cutoff:
+                    continue
+                os.rename(claimed_path, self._job_dir(job_id, 'pending', name))
+            except FileNotFoundError:
+                # Completed or requeued by another worker meanwhile
+                continue
+            requeued += 1
+        return requeued
+
+    def claim(self, job_id):
+        """Claim the next pending shard of a job, or return None"""
+        self.requeue_stale_claims(job_id)
+        pending_dir = self._job_dir(job_id, 'pending')
+        try:
+            names = sorted(os.listdir(pending_dir))
+        except FileNotFoundError:
+            return None
+
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            pending_path = os.path.join(pending_dir, name)
+            if os.path.exists(self._job_dir(job_id, 'done', name)):
+                # Finished late by a worker whose claim had been requeued
+                try:
+                    os.remove(pending_path)
+                except FileNotFoundError:
+                    pass
+                continue
+            claimed_path = self._job_dir(job_id, 'claimed', name)
+            try:
+                os.rename(pending_path, claimed_path)
+            except FileNotFoundError:
+                # Another worker got there first
+                continue
+            try:
+                # rename keeps the publish time; the claim's age starts now
+                os.utime(claimed_path)
+                return self._read_json(claimed_path)
+            except FileNotFoundError:
+                # Requeued as stale before the timestamp was updated
+                continue
+
+        return None
+
+    def complete(self, job_id, shard, result):
+        """Store a shard result and release its claim"""
+        name = f"{shard['seq']:08d}.json"
+        self._write_json(self._job_dir(job_id, 'done', name), result)
+        try:
+            os.remove(self._job_dir(job_id, 'claimed', name))
+        except FileNotFoundError:
+            pass
+
+    def is_complete(self, job_id):
+        """Check whether every shard of a job has a result"""
+        job = self._read_json(self._job_dir(job_id, 'job.json'))
+        done = [name for name in os.listdir(self._job_dir(job_id, 'done')) if name.endswith('.json')]
+        return len(done) == job['shard_count']
+
+    def work(self, job_id, gemini_service=None):
+        """Process shards of a job until none are pending"""
+        job = self._read_json(self._job_dir(job_id, 'job.json'))
+        gemini_service = gemini_service or GeminiService()
+        engine = None
+        processed = 0
+
+        shard = self.claim(job_id)
+        while shard is not None:
+            # Feature matrices are built once, and only if there is work
+            engine = engine or prepared_engine(job['assets'], job['rules'])
+            result = execute_shard(shard, job['assets'], job['rules'], gemini_service, engine)
+            self.complete(job_id, shard, result)
+            processed += 1
+            shard = self.claim(job_id)
+
+        return processed
+
+    def collect(self, job_id):
+        """Merge the results of a finished job"""
+        done_dir = self._job_dir(job_id, 'done')
+        results = [
+            self._read_json(os.path.join(done_dir, name))
+            for name in sorted(os.listdir(done_dir))
+            if name.endswith('.json')
+        ]
+        return merge_shard_results(results)
+
+
+if __name__ == '__main__':
+    # Usage: python -m services.shard_executor <queue_dir> <job_id>
+    queue = ShardQueue(sys.argv[1])
+    count = queue.work(sys.argv[2])
+    print(f"Processed {count} shards")
@@ -0,0 +1,203 @@
+import numpy as np
+
+from services.continuity_checks import get_scene_number, is_asset
+
+DEFAULT_TOP_K = 10
+# Indexed features feature_vector() reads
+SIMILARITY_FEATURES = ['color_histogram', 'perceptual_hash', 'luminance', 'lighting']
+
+
+def feature_vector(features):
+    """Flatten indexed asset features into one L2-normalized vector
+
+    Returns None when the asset has not been indexed yet.
+    """
+    if not features or not features.get('color_histogram') or not features.get('perceptual_hash'):
+        return None
+
+    # Square roots turn histogram dot products into the Bhattacharyya coefficient
+    histogram = np.sqrt(np.asarray(features['color_histogram'], dtype=np.float64))
+
+    hash_value = int(features['perceptual_hash'], 16)
+    hash_bits = np.array([(hash_value >> shift) & 1 for shift in range(63, -1, -1)], dtype=np.float64)
+    hash_part = (hash_bits * 2.0 - 1.0) / 8.0
+
+    parts = [histogram, hash_part]
+
+    luminance = features.get('luminance')
+    if luminance:
+        parts.append(np.array([luminance['mean'], luminance['std'], luminance['p5'], luminance['p95']]) / 255.0)
+    else:
+        parts.append(np.zeros(4))
+
+    lighting = features.get('lighting')
+    if lighting:
+        parts.append(np.asarray(lighting['direction'], dtype=np.float64) * 0.5)
+    else:
+        parts.append(np.zeros(2))
+
+    vector = np.concatenate(parts)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else None
+
+
+class SimilarityIndex:
+    """Random-hyperplane LSH over L2-normalized vectors
+
+    Each of num_tables tables hashes a vector to num_bits sign bits. Queries
+    collect candidates from the matching bucket in every table, plus buckets
+    one bit away, and rank them by exact cosine similarity.
+    """
+
+    def __init__(self, num_tables=8, num_bits=12, seed=0):
+        self.num_tables = num_tables
+        self.num_bits = num_bits
+        self.seed = seed
+        self.vectors = None
+        self.planes = None
+        self.tables = []
+        self.codes = None
+
+    def build(self, vectors):
+        """Index a (n, d) matrix of vectors"""
+        self.vectors = np.asarray(vectors, dtype=np.float64)
+        _, dimensions = self.vectors.shape
+        rng = np.random.default_rng(self.seed)
+        self.planes = rng.standard_normal((self.num_tables, dimensions, self.num_bits))
+        weights = 1 << np.arange(self.num_bits, dtype=np.int64)
+
+        # (tables, n, bits) sign bits packed into one integer key per table
+        bits = np.einsum('nd,tdb->tnb', self.vectors, self.planes) > 0
+        self.codes = (bits * weights).sum(axis=2)
+
+        self.tables = []
+        for table in range(self.num_tables):
+            buckets = {}
+            for index, code in enumerate(self.codes[table].tolist()):
+                buckets.setdefault(code, []).append(index)
+            self.tables.append(buckets)
+        return self
+
+    def candidates(self, index):
+        """Indices that share a bucket with a vector, or sit one bit away from it"""
+        found = set()
+        for table, buckets in enumerate(self.tables):
+            code = int(self.codes[table, index])
+            found.update(buckets.get(code, ()))
+            for bit in range(self.num_bits):
+                found.update(buckets.get(code ^ (1 << bit), ()))
+        found.discard(index)
+        return found
+
+    def query(self, index, k, allowed=None):
+        """Return up to k (index, similarity) neighbours, most similar first"""
+        candidates = self.candidates(index)
+        if allowed is not None:
+            candidates = [candidate for candidate in candidates if allowed(candidate)]
+        if not candidates:
+            return []
+
+        candidates = np.fromiter(candidates, dtype=np.int64)
+        similarities = self.vectors[candidates] @ self.vectors[index]
+        if len(candidates) > k:
+            top = np.argpartition(-similarities, k - 1)[:k]
+        else:
+            top = np.arange(len(candidates))
+        top = top[np.argsort(-similarities[top], kind='stable')]
+        return [(int(candidates[position]), float(similarities[position])) for position in top]
+
+
+def _cross_scene_count(scenes):
+    """Number of pairs of positions from different scenes"""
+    counts = {}
+    for scene in scenes:
+        counts[scene] = counts.get(scene, 0) + 1
+    total = sum(counts.values())
+    return (total * total - sum(count * count for count in counts.values())) // 2
+
+
+class SimilarPairs:
+    """Candidate pairs from similar_pairs, generated on demand
+
+    Similar pairs of indexed assets are kept, at most top_k per asset. Pairs
+    involving an asset that is not indexed yet are generated as they are
+    iterated, so a freshly uploaded project does not materialize its whole
+    pair space. Iterates (i, j), i < j, in ascending order, and can be
+    iterated more than once.
+    """
+
+    def __init__(self, scenes, neighbours, unindexed):
+        # scenes maps position -> scene for every asset with a scene
+        self.scenes = scenes
+        self.positions = sorted(scenes)
+        self.neighbours = neighbours
+        self.unindexed = unindexed
+        similar = sum(len(others) for others in neighbours.values())
+        indexed_scenes = [scene for position, scene in scenes.items() if position not in unindexed]
+        self.length = similar + _cross_scene_count(scenes.values()) - _cross_scene_count(indexed_scenes)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for position in self.positions:
+            scene = self.scenes[position]
+            others = set(self.neighbours.get(position, ()))
+            fallback = self.positions if position in self.unindexed else sorted(self.unindexed)
+            others.update(
+                other for other in fallback
+                if other > position and self.scenes[other] != scene
+            )
+            for other in sorted(others):
+                yield position, other
+
+    def between(self, left, right):
+        """Yield the pairs with one asset in left and the other in right
+
+        left and right hold positions from two different scenes.
+        """
+        right_set = set(right)
+        for position in left:
+            for other in right:
+                if position in self.unindexed or other in self.unindexed:
+                    yield min(position, other), max(position, other)
+            for other in self.neighbours.get(position, ()):
+                if other in right_set:
+                    yield position, other
+        left_set = set(left)
+        for other in right:
+            for position in self.neighbours.get(other, ()):
+                if position in left_set:
+                    yield other, position
+
+
+def similar_pairs(assets, top_k=DEFAULT_TOP_K, num_tables=8, num_bits=12):
+    """Cross-scene pairs where one asset is among the other's top-k similar shots
+
+    Assets without indexed features cannot be ranked, so all of their
+    cross-scene pairs are kept. Returns a SimilarPairs of (i, j) with i < j.
+    """
+    scenes = {}
+    vectors = {}
+    for index, asset in enumerate(assets):
+        if is_asset(asset) and get_scene_number(asset):
+            scenes[index] = get_scene_number(asset)
+            vector = feature_vector(asset.get('features'))
+            if vector is not None:
+                vectors[index] = vector
+
+    neighbours = {}
+    if vectors:
+        positions = list(vectors)
+        index = SimilarityIndex(num_tables=num_tables, num_bits=num_bits).build([vectors[p] for p in positions])
+        position_scenes = [scenes[p] for p in positions]
+
+        for row, position in enumerate(positions):
+            scene = position_scenes[row]
+            for neighbour, _ in index.query(row, top_k, allowed=lambda other: position_scenes[other] != scene):
+                other = positions[neighbour]
+                neighbours.setdefault(min(position, other), set()).add(max(position, other))
+
+    # Unindexed assets fall back to comparison against every other scene
+    unindexed = {position for position in scenes if position not in vectors}
+    return SimilarPairs(scenes, neighbours, unindexed)
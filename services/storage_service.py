@@ -1,12 +1,20 @@
 import os
 import uuid
+import json
 from datetime import datetime
-from firebase_admin import firestore, storage
+from firebase_admin import firestore
+
+from services.search_index import AssetSearchIndex
+from services.document_loader import loader_for
+from services.persistence import get_database, get_bucket
+
+STREAM_CHUNK_SIZE = 1024 * 1024
 
 class StorageService:
     def __init__(self):
-        self.db = firestore.client()
-        self.bucket = storage.bucket()
+        self.db = get_database()
+        self.bucket = get_bucket()
+        self.search_index = AssetSearchIndex()
     
     def create_project(self, user_id, data):
         """Create a new project"""
@@ -25,18 +33,16 @@ class StorageService:
         }
         
         # Store in Firestore
-        self.db.collection('projects').document(project_id).set(project_data)
+        loader_for(self.db).set('projects', project_id, project_data)
         
         return project_data
     
     def get_project(self, project_id, user_id):
         """Get project details, ensuring user has access"""
         try:
-            project_ref = self.db.collection('projects').document(project_id).get()
-            if not project_ref.exists:
+            project = loader_for(self.db).get('projects', project_id)
+            if not project:
                 return None
-                
-            project = project_ref.to_dict()
             
             # Check if user has access
             if user_id not in project.get('members', []):
@@ -52,9 +58,8 @@ class StorageService:
         projects = []
         
         try:
-            project_docs = self.db.collection('projects').where('members', 'array_contains', user_id).stream()
-            for doc in project_docs:
-                project = doc.to_dict()
+            query = self.db.collection('projects').where('members', 'array_contains', user_id)
+            for project in loader_for(self.db).stream('projects', query):
                 projects.append(project)
             
             return projects
@@ -111,7 +116,8 @@ class StorageService:
             }
             
             # Store in Firestore
-            self.db.collection('assets').document(asset_id).set(asset_data)
+            loader_for(self.db).set('assets', asset_id, asset_data)
+            self.search_index.add_asset(asset_data)
             
             return asset_data
         except Exception as e:
@@ -123,9 +129,8 @@ class StorageService:
         assets = []
         
         try:
-            asset_docs = self.db.collection('assets').where('project_id', '==', project_id).stream()
-            for doc in asset_docs:
-                asset = doc.to_dict()
+            query = self.db.collection('assets').where('project_id', '==', project_id)
+            for asset in loader_for(self.db).stream('assets', query):
                 assets.append(asset)
             
             return assets
@@ -133,6 +138,77 @@ class StorageService:
             print(f"Error getting assets: {str(e)}")
             return []
     
+    def search_assets(self, project_id, tags=None, scene=None, shot=None, content_type=None,
+                      asset_type=None, uploaded_after=None, uploaded_before=None):
+        """Search project assets through the in-memory index"""
+        try:
+            return self.search_index.search(
+                project_id, self.get_project_assets,
+                tags=tags, scene=scene, shot=shot, content_type=content_type,
+                asset_type=asset_type, uploaded_after=uploaded_after, uploaded_before=uploaded_before
+            )
+        except Exception as e:
+            print(f"Error searching assets: {str(e)}")
+            return []
+    
+    def get_asset(self, project_id, asset_id):
+        """Get a single asset of a project"""
+        try:
+            asset = loader_for(self.db).get('assets', asset_id)
+            if not asset:
+                return None
+                
+            if asset.get('project_id') != project_id:
+                return None
+                
+            return asset
+        except Exception as e:
+            print(f"Error getting asset: {str(e)}")
+            return None
+    
+    def delete_asset(self, project_id, asset_id):
+        """Delete an asset and its stored file"""
+        try:
+            asset = self.get_asset(project_id, asset_id)
+            if not asset:
+                return False
+            
+            # Remove the original and any generated proxies from Cloud Storage
+            storage_paths = [asset['storage_path']]
+            for derived in ('proxy', 'thumbnail_strip'):
+                if (asset.get(derived) or {}).get('storage_path'):
+                    storage_paths.append(asset[derived]['storage_path'])
+            if asset.get('proxy'):
+                storage_paths.append(f"projects/{project_id}/thumbnails/{asset_id}.jpg")
+            for storage_path in storage_paths:
+                blob = self.bucket.blob(storage_path)
+                if blob.exists():
+                    blob.delete()
+            
+            loader = loader_for(self.db)
+            loader.delete('assets', asset_id)
+            loader.delete('asset_features', asset_id)
+            self.search_index.remove_asset(project_id, asset_id)
+            
+            return True
+        except Exception as e:
+            print(f"Error deleting asset: {str(e)}")
+            return False
+    
+    def get_blob_size(self, storage_path):
+        """Size in bytes of a stored file, or None if it does not exist"""
+        blob = self.bucket.get_blob(storage_path)
+        return blob.size if blob else None
+    
+    def stream_blob(self, storage_path, start, end, chunk_size=STREAM_CHUNK_SIZE):
+        """Yield bytes start..end (inclusive) of a stored file in chunks"""
+        blob = self.bucket.blob(storage_path)
+        position = start
+        while position <= end:
+            chunk_end = min(position + chunk_size - 1, end)
+            yield blob.download_as_bytes(start=position, end=chunk_end)
+            position = chunk_end + 1
+    
     def create_rule(self, user_id, data):
         """Create a continuity rule"""
         rule_id = str(uuid.uuid4())
@@ -152,40 +228,39 @@ class StorageService:
         }
         
         # Store in Firestore
-        self.db.collection('rules').document(rule_id).set(rule_data)
+        loader_for(self.db).set('rules', rule_id, rule_data)
         
         return rule_data
     
     def get_user_rules(self, user_id):
         """Get all rules created by or accessible to a user"""
         rules = []
+        seen = set()
         
         try:
-            # Get user-created rules
-            rule_docs = self.db.collection('rules').where('created_by', '==', user_id).stream()
-            for doc in rule_docs:
-                rule = doc.to_dict()
-                rules.append(rule)
-            
-            # Get global rules
-            global_docs = self.db.collection('rules').where('is_global', '==', True).stream()
-            for doc in global_docs:
-                rule = doc.to_dict()
-                if rule.get('id') not in [r.get('id') for r in rules]:  # Avoid duplicates
-                    rules.append(rule)
-            
-            # Get project-specific rules for projects the user is a member of
+            loader = loader_for(self.db)
+            rules_ref = self.db.collection('rules')
+            queries = [
+                # User-created rules
+                rules_ref.where('created_by', '==', user_id),
+                # Global rules
+                rules_ref.where('is_global', '==', True)
+            ]
+            
+            # Project-specific rules for projects the user is a member of,
+            # ten project IDs per 'in' query instead of one query each
             user_projects = self.get_user_projects(user_id)
             project_ids = [p.get('id') for p in user_projects]
+            for start in range(0, len(project_ids), 10):
+                queries.append(rules_ref.where('project_id', 'in', project_ids[start:start + 10]))
             
-            for project_id in project_ids:
-                project_docs = self.db.collection('rules').where('project_id', '==', project_id).stream()
-                for doc in project_docs:
-                    rule = doc.to_dict()
-                    if rule.get('id') not in [r.get('id') for r in rules]:  # Avoid duplicates
+            for query in queries:
+                for rule in loader.stream('rules', query):
+                    if rule.get('id') not in seen:  # Avoid duplicates
+                        seen.add(rule.get('id'))
                         rules.append(rule)
             
             return rules
         except Exception as e:
             print(f"Error getting rules: {str(e)}")
-            return []
\ No newline at end of file
+            return []